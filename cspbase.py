@@ -1,5 +1,17 @@
 import time
 import functools
+import itertools
+import math
+import heapq
+import random
+import weakref
+
+#number of set bits of a domain bitmask
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+else:
+    def popcount(mask):
+        return bin(mask).count('1')
 
 '''Constraint Satisfaction Routines
    A) class Variable
@@ -11,7 +23,7 @@ import functools
       added but NOT deleted from.
       
       To support constraint propagation, the class also maintains a
-      set of flags to indicate if a value is still in its current domain.
+      bitmask of flags to indicate if a value is still in its current domain.
       So one can remove values, add them back, and query if they are 
       still current. 
 
@@ -30,9 +42,27 @@ import functools
       for each variable in the constraint (in the same ORDER as the
       variables of the constraint were specified).
 
+      Tables shared by many constraints can be given as an interned
+      Relation instead (see intern_relation), stored once per process.
+
+      Alternatively the constraint can be given a check function (and
+      optionally a support function) in which case the table of
+      satisfying tuples is never built.
+
+      AllDiffConstraint is an all-different constraint that needs
+      neither, its supports are found by bipartite matching.
+      SumConstraint is a linear sum constraint propagated on bounds.
+      NogoodConstraint forbids one combination of values, it is how
+      backjumping search records what it learned.
+
     C) Backtracking routine---takes propagator and CSP as arguments
        so that basic backtracking, forward-checking or GAC can be 
-       executed depending on the propagator used.
+       executed depending on the propagator used, optionally with
+       randomized restarts or conflict directed backjumping that learns
+       nogoods (see BT.bt_search). Search events can be
+       observed by SearchListeners (e.g. SearchProfile) and constraints
+       can count the work done on them (see BT.add_listener and
+       BT.enable_constraint_stats).
 
 '''
 
@@ -45,8 +75,10 @@ class Variable:
 
        The variable object offers two types of functionality to support
        search. 
-       (a) It has a current domain, implimented as a set of flags 
-           determining which domain values are "current", i.e., unpruned.
+       (a) It has a current domain, implimented as an integer bitmask
+           (bit i is set iff the i-th domain value is "current", i.e.,
+           unpruned), so membership, pruning, restoring and counting
+           are O(1) word operations.
            - you can prune a value, and restore it.
            - you can obtain a list of values in the current domain, or count
              how many are still there
@@ -80,17 +112,37 @@ class Variable:
         string). Optionally specify the initial domain.
         '''
         self.name = name                #text name for variable
-        self.dom = list(domain)         #Make a copy of passed domain
-        self.curdom = [True] * len(domain)      #using list
+        self.dom = []
+        self.dom_index = dict()         #value -> bit position in curdom
+        self.curdom = 0                 #bitmask, bit i set iff dom[i] is current
         #for bt_search
         self.assignedValue = None
+        #set by bt_search: every change to curdom is first saved on the
+        #trail (once per trail stamp) so search can undo it
+        self.trail = None
+        self.trail_stamp = -1
+        #set by bt_search: told about every change of the domain size
+        self.mrv_index = None
+        #set by a backjumping bt_search: explain(var, value, reason) is
+        #told about every pruning (see BT.explain_pruning)
+        self.explain = None
+        #constraints whose domain_changed(var) is called after every
+        #change of the current domain or assignment (see
+        #SumConstraint.watch)
+        self.watchers = None
+        self.add_domain_values(domain)  #Make a copy of passed domain
 
     def add_domain_values(self, values):
         '''Add additional domain values to the domain
            Removals not supported removals'''
         for val in values: 
+            if not val in self.dom_index:
+                self.dom_index[val] = len(self.dom)
+            self.curdom |= 1 << len(self.dom)
             self.dom.append(val)
-            self.curdom.append(True)
+        if self.watchers is not None:
+            for c in self.watchers:
+                c.domain_changed(self)
 
     def domain_size(self):
         '''Return the size of the (permanent) domain'''
@@ -104,48 +156,81 @@ class Variable:
     #methods for current domain (pruning and unpruning)
     #
 
-    def prune_value(self, value):
-        '''Remove value from CURRENT domain'''
-        self.curdom[self.value_index(value)] = False
+    def prune_value(self, value, reason=None):
+        '''Remove value from CURRENT domain. Propagators give the
+           constraint that rules value out as reason, for backjumping
+           search (None means the cause is unknown).'''
+        if self.explain is not None:
+            self.explain(self, value, reason)
+        #save_curdom inlined, this is the hottest call during search
+        trail = self.trail
+        if trail is not None and self.trail_stamp != trail.stamp:
+            trail.save(self, self.curdom)
+            self.trail_stamp = trail.stamp
+        self.curdom &= ~(1 << self.dom_index[value])
+        if self.mrv_index is not None:
+            self.mrv_index.update(self)
+        if self.watchers is not None:
+            for c in self.watchers:
+                c.domain_changed(self)
 
     def unprune_value(self, value):
         '''Restore value to CURRENT domain'''
-        self.curdom[self.value_index(value)] = True
+        self.save_curdom()
+        self.curdom |= 1 << self.dom_index[value]
+        if self.mrv_index is not None:
+            self.mrv_index.update(self)
+        if self.watchers is not None:
+            for c in self.watchers:
+                c.domain_changed(self)
 
     def cur_domain(self):
         '''return list of values in CURRENT domain (if assigned 
            only assigned value is viewed as being in current domain)'''
+        if self.assignedValue is not None:
+            return [self.assignedValue]
         vals = []
-        if self.is_assigned():
-            vals.append(self.get_assigned_value())
-        else:
-            for i, val in enumerate(self.dom):
-                if self.curdom[i]:
-                    vals.append(val)
+        dom = self.dom
+        mask = self.curdom
+        while mask:
+            low = mask & -mask
+            vals.append(dom[low.bit_length() - 1])
+            mask ^= low
         return vals
 
     def in_cur_domain(self, value):
         '''check if value is in CURRENT domain (without constructing list)
            if assigned only assigned value is viewed as being in current 
            domain'''
-        if not value in self.dom:
+        i = self.dom_index.get(value)
+        if i is None:
             return False
-        if self.is_assigned():
-            return value == self.get_assigned_value()
-        else:
-            return self.curdom[self.value_index(value)]
+        if self.assignedValue is not None:
+            return value == self.assignedValue
+        return (self.curdom >> i) & 1 == 1
 
     def cur_domain_size(self):
         '''Return the size of the variables domain (without construcing list)'''
-        if self.is_assigned():
+        if self.assignedValue is not None:
             return 1
-        else:
-            return(sum(1 for v in self.curdom if v))
+        return popcount(self.curdom)
+
+    def cur_domain_mask(self):
+        '''Return the CURRENT domain as a bitmask over the (permanent)
+           domain positions (if assigned only the assigned value's bit)'''
+        if self.assignedValue is not None:
+            return 1 << self.dom_index[self.assignedValue]
+        return self.curdom
 
     def restore_curdom(self):
         '''return all values back into CURRENT domain'''
-        for i in range(len(self.curdom)):
-            self.curdom[i] = True
+        self.save_curdom()
+        self.curdom = (1 << len(self.dom)) - 1
+        if self.mrv_index is not None:
+            self.mrv_index.update(self)
+        if self.watchers is not None:
+            for c in self.watchers:
+                c.domain_changed(self)
 
     #
     #methods for assigning and unassigning
@@ -165,6 +250,9 @@ class Variable:
             return
 
         self.assignedValue = value
+        if self.watchers is not None:
+            for c in self.watchers:
+                c.domain_changed(self)
 
     def unassign(self):
         '''Used by bt_search. Unassign and restore old curdom'''
@@ -172,6 +260,9 @@ class Variable:
             print("ERROR: trying to unassign variable", self, " not yet assigned")
             return
         self.assignedValue = None
+        if self.watchers is not None:
+            for c in self.watchers:
+                c.domain_changed(self)
 
     def get_assigned_value(self):
         '''return assigned value...returns None if is unassigned'''
@@ -181,10 +272,27 @@ class Variable:
     #internal methods
     #
 
+    def save_curdom(self):
+        '''Save the current domain on the trail (if any) before it is
+           changed, at most once per trail stamp'''
+        trail = self.trail
+        if trail is not None and self.trail_stamp != trail.stamp:
+            trail.save(self, self.curdom)
+            self.trail_stamp = trail.stamp
+
+    def restore_state(self, curdom):
+        '''Called by Trail.undo to put back a saved current domain'''
+        self.curdom = curdom
+        if self.mrv_index is not None:
+            self.mrv_index.update(self)
+        if self.watchers is not None:
+            for c in self.watchers:
+                c.domain_changed(self)
+
     def value_index(self, value):
         '''Domain values need not be numbers, so return the index
            in the domain list of a variable value'''
-        return self.dom.index(value)
+        return self.dom_index[value]
 
     def __repr__(self):
         return("Var-{}".format(self.name))
@@ -196,7 +304,75 @@ class Variable:
         '''Also print the variable domain and current domain'''
         print("Var--\"{}\": Dom = {}, CurDom = {}".format(self.name, 
                                                              self.dom, 
-                                                             self.curdom))
+                                                             [(self.curdom >> i) & 1 == 1
+                                                              for i in range(len(self.dom))]))
+class Relation:
+    '''Immutable table of satisfying tuples that any number of
+       constraints can share (see Constraint.use_relation). Its support
+       index is by scope position instead of by variable, so it does not
+       depend on the scope it is used with. Compact-Table masks are
+       computed once per combination of variable domains and shared as
+       well.'''
+
+    def __init__(self, tuples):
+        self.sat_tuples = dict.fromkeys(tuple(t) for t in tuples)
+        self.tuples = tuple(self.sat_tuples)
+        #(scope position, value) -> list of tuples with that value there
+        self.supports = dict()
+        for t in self.tuples:
+            for i, val in enumerate(t):
+                self.supports.setdefault((i, val), []).append(t)
+        self.ct_cache = dict()
+
+    def ct_masks(self, scope):
+        '''Compact-Table (supports, all) masks of the table for the
+           domains of the variables in scope (see ct_support_masks)'''
+        key = tuple([tuple(var.dom) for var in scope])
+        masks = self.ct_cache.get(key)
+        if masks is None:
+            masks = ct_support_masks(self.tuples, scope)
+            self.ct_cache[key] = masks
+        return masks
+
+    def __len__(self):
+        return len(self.tuples)
+
+#the interned relations of this process, shared while some constraint
+#still uses them
+interned_relations = weakref.WeakValueDictionary()
+
+def intern_relation(tuples):
+    '''Return the Relation of tuples, the same object for every call with
+       the same tuples (in the same order)'''
+    key = tuple([tuple(t) for t in tuples])
+    relation = interned_relations.get(key)
+    if relation is None:
+        relation = Relation(key)
+        interned_relations[key] = relation
+    return relation
+
+def ct_support_masks(tuples, scope):
+    '''Number the tuples whose values are all in the domains of the
+       variables of scope and return (supports, all): supports[i][b] is
+       the bitmask of the tuples with value dom[b] of scope[i] at
+       position i, all the bitmask of every numbered tuple'''
+    supports = [[0] * len(var.dom) for var in scope]
+    all = 0
+    k = 0
+    for t in tuples:
+        bits = []
+        for i, var in enumerate(scope):
+            b = var.dom_index.get(t[i])
+            if b is None:
+                break
+            bits.append(b)
+        else:
+            for i, b in enumerate(bits):
+                supports[i][b] |= 1 << k
+            all |= 1 << k
+            k += 1
+    return supports, all
+
 class Constraint: 
     '''Class for defining constraints variable objects specifes an
        ordering over variables.  This ordering is used when calling
@@ -214,23 +390,60 @@ class Constraint:
         in the scope such that this sequence of values satisfies the
         constraints).
 
-        NOTE: This is a very space expensive representation...a proper
-        constraint object would allow for representing the constraint
-        with a function.  
+        NOTE: This is a very space expensive representation...so a
+        constraint can instead be represented with a function (see
+        add_check_function).
         '''
 
         self.scope = list(scope)
         self.name = name
         self.sat_tuples = dict()
 
+        #A shared Relation (see use_relation) replaces sat_tuples and
+        #sup_tuples when set.
+        self.relation = None
+
         #The next object data item 'sup_tuples' will be used to help
         #support GAC propgation. It allows access to a list of 
         #satisfying tuples that contain a particular variable/value
         #pair.
         self.sup_tuples = dict()
 
+        #'residues' caches, for each variable/value pair, the position in
+        #its sup_tuples list of the last support found. It is only a hint
+        #(always rechecked) so it never needs restoring on backtracking.
+        self.residues = dict()
+
+        #Compact-Table state used by find_unsupported (see ct_update),
+        #built lazily from sat_tuples and dropped when tuples are added.
+        self.ct_supports = None
+        self.ct_table = 0
+        self.ct_last = None
+        self.ct_trail_stamp = -1
+
+        #For intensional constraints (no table) 'check_fn' tests a full
+        #list of values and 'support_fn' optionally replaces the
+        #generic support search in has_support.
+        self.check_fn = None
+        self.support_fn = None
+
+        #ConstraintStats while instrumentation is on (see
+        #BT.enable_constraint_stats), None otherwise
+        self.stats = None
+
+        #failure weight for conflict driven variable ordering (see
+        #DomWdegOrder), bumped by the propagators on every wipeout
+        self.weight = 1
+
     def add_satisfying_tuples(self, tuples):
         '''We specify the constraint by adding its complete list of satisfying tuples.'''
+        if self.relation is not None:
+            #copy the shared table before changing it
+            relation = self.relation
+            self.relation = None
+            self.sat_tuples = dict()
+            self.sup_tuples = dict()
+            self.add_satisfying_tuples(relation.tuples)
         for x in tuples:
             t = tuple(x)  #ensure we have an immutable tuple
             if not t in self.sat_tuples:
@@ -242,6 +455,45 @@ class Constraint:
                 if not (var,val) in self.sup_tuples:
                     self.sup_tuples[(var,val)] = []
                 self.sup_tuples[(var,val)].append(t)
+        self.ct_supports = None
+
+    def use_relation(self, relation):
+        '''Specify the constraint by a Relation (see intern_relation)
+           shared with other constraints instead of a table of its own.
+           The relation's tuples give values in scope order.'''
+        self.relation = relation
+        self.sat_tuples = relation.sat_tuples
+        self.sup_tuples = dict()
+        self.residues = dict()
+        self.ct_supports = None
+
+    def add_check_function(self, check_fn, support_fn=None):
+        '''Specify the constraint by a function instead of a table.
+
+           check_fn(vals) is given a list of values, one for each variable
+           in the scope (in scope order), and returns True iff they
+           satisfy the constraint.
+
+           support_fn(constraint, var, val) is optional. If given it is
+           used by has_support and must return True iff var=val can be
+           extended to a satisfying tuple using values in the current
+           domains of the other variables. If not given has_support
+           searches the current domains using check_fn.'''
+        self.check_fn = check_fn
+        self.support_fn = support_fn
+
+    def bump_weight(self):
+        '''A propagator failed on this constraint: increase its weight
+           and tell the unassigned vars heap that the keys of the scope
+           may have changed'''
+        self.weight += 1
+        for var in self.scope:
+            if var.mrv_index is not None:
+                var.mrv_index.update(var)
+
+    def is_intensional(self):
+        '''return True if the constraint is given by a check function'''
+        return self.check_fn is not None
 
     def get_scope(self):
         '''get list of variables the constraint is over'''
@@ -254,6 +506,8 @@ class Constraint:
            constraints "satisfies" function.  Note the list of values
            are must be ordered in the same order as the list of
            variables in the constraints scope'''
+        if self.check_fn is not None:
+            return self.check_fn(list(vals))
         return tuple(vals) in self.sat_tuples
 
     def get_n_unasgn(self):
@@ -278,10 +532,183 @@ class Constraint:
            of assignments satisfying the constraint where each value is
            still in the corresponding variables current domain
         '''
-        if (var, val) in self.sup_tuples:
-            for t in self.sup_tuples[(var, val)]:
-                if self.tuple_is_valid(t):
-                    return True
+        if self.stats is not None:
+            self.stats.support_checks += 1
+        if self.check_fn is not None:
+            if not var.in_cur_domain(val):
+                return False
+            if self.support_fn is not None:
+                return self.support_fn(self, var, val)
+            return self.search_support(var, val)
+        key = (var, val)
+        if self.relation is not None:
+            if not var in self.scope:
+                return False
+            sup = self.relation.supports.get((self.scope.index(var), val))
+        else:
+            sup = self.sup_tuples.get(key)
+        if sup is None:
+            return False
+        #the last support found usually still holds, only if it is gone
+        #do we scan the list (and remember the new support)
+        r = self.residues.get(key)
+        stats = self.stats
+        if r is not None:
+            if stats is not None:
+                stats.tuples_scanned += 1
+            if self.tuple_is_valid(sup[r]):
+                return True
+        for i, t in enumerate(sup):
+            if self.tuple_is_valid(t):
+                self.residues[key] = i
+                if stats is not None:
+                    stats.tuples_scanned += i + 1
+                return True
+        if stats is not None:
+            stats.tuples_scanned += len(sup)
+        return False
+
+    def find_unsupported(self):
+        '''Return the list of (var, val) pairs, val in the CURRENT domain
+           of var, that have no supporting tuple. Used by GAC to revise
+           the whole constraint at once; global constraints override this
+           to compute all the unsupported pairs in one pass. Table
+           constraints use Compact-Table (see ct_update).'''
+        if self.check_fn is None:
+            return self.ct_find_unsupported()
+        unsupported = []
+        for var in self.scope:
+            for val in var.cur_domain():
+                if not self.has_support(var, val):
+                    unsupported.append((var, val))
+        return unsupported
+
+    #
+    #Compact-Table (bitset STR) propagation for table constraints
+    #
+    #The satisfying tuples are numbered, and for each scope position i
+    #and domain bit b of scope[i] ct_supports[i][b] is the bitmask of the
+    #tuples with that value at position i. ct_table is the bitmask of
+    #tuples that are still valid given the current domains, which were
+    #last seen as the masks in ct_last. A value is supported iff its
+    #support mask meets ct_table, so a revision is a few word-level ANDs.
+    #ct_table/ct_last are saved on the variables' trail during search so
+    #they are restored together with the domains.
+    #
+
+    def ct_build(self):
+        '''Internal routine. Build (or get from the shared relation) the
+           per value support masks'''
+        if self.relation is not None:
+            self.ct_supports, self.ct_all = self.relation.ct_masks(self.scope)
+        else:
+            self.ct_supports, self.ct_all = ct_support_masks(self.sat_tuples, self.scope)
+        self.ct_dom_sizes = [len(var.dom) for var in self.scope]
+        self.ct_reset()
+
+    def ct_reset(self):
+        '''Internal routine. Start again from the full table'''
+        self.ct_table = self.ct_all
+        self.ct_last = [(1 << n) - 1 for n in self.ct_dom_sizes]
+
+    def ct_save(self):
+        '''Internal routine. Save ct_table/ct_last on the trail (if the
+           variables have one) before they change, once per stamp'''
+        trail = self.scope[0].trail if self.scope else None
+        if trail is not None and self.ct_trail_stamp != trail.stamp:
+            trail.save(self, (self.ct_table, list(self.ct_last)))
+            self.ct_trail_stamp = trail.stamp
+
+    def restore_state(self, state):
+        '''Called by Trail.undo to put back saved Compact-Table state'''
+        self.ct_table, self.ct_last = state
+
+    def ct_update(self):
+        '''Internal routine. Remove from ct_table the tuples invalidated
+           by the domain changes since the last update. Uses the removed
+           values or the remaining ones, whichever are fewer. If some
+           domain grew (e.g. it was restored without the trail) the
+           table is recomputed from scratch.'''
+        if self.ct_supports is None:
+            self.ct_build()
+        masks = [var.cur_domain_mask() for var in self.scope]
+        last = self.ct_last
+        for i, mask in enumerate(masks):
+            if mask & ~last[i]:
+                if [len(var.dom) for var in self.scope] != self.ct_dom_sizes:
+                    self.ct_build()
+                self.ct_save()
+                self.ct_reset()
+                last = self.ct_last
+                break
+        table = self.ct_table
+        for i, mask in enumerate(masks):
+            if mask == last[i]:
+                continue
+            self.ct_save()
+            last = self.ct_last
+            sups = self.ct_supports[i]
+            removed = last[i] & ~mask
+            keep = 0
+            n_removed = popcount(removed)
+            n_kept = popcount(mask)
+            if self.stats is not None:
+                self.stats.tuples_scanned += min(n_removed, n_kept)
+            if n_removed < n_kept:
+                while removed:
+                    low = removed & -removed
+                    keep |= sups[low.bit_length() - 1]
+                    removed ^= low
+                table &= ~keep
+            else:
+                m = mask
+                while m:
+                    low = m & -m
+                    keep |= sups[low.bit_length() - 1]
+                    m ^= low
+                table &= keep
+            last[i] = mask
+            self.ct_table = table
+        return masks
+
+    def ct_find_unsupported(self):
+        '''Internal routine. find_unsupported for table constraints'''
+        masks = self.ct_update()
+        table = self.ct_table
+        unsupported = []
+        for i, var in enumerate(self.scope):
+            sups = self.ct_supports[i]
+            m = masks[i]
+            while m:
+                low = m & -m
+                b = low.bit_length() - 1
+                if not table & sups[b]:
+                    unsupported.append((var, var.dom[b]))
+                m ^= low
+        if self.stats is not None:
+            #one support mask tested per value
+            n = 0
+            for m in masks:
+                n += popcount(m)
+            self.stats.support_checks += n
+            self.stats.tuples_scanned += n
+        return unsupported
+
+    def search_support(self, var, val):
+        '''Internal routine. Generic support search for intensional
+           constraints: try the combinations of current domain values
+           of the other variables (with var fixed to val) until check_fn
+           accepts one. Exponential in the scope size so intensional
+           constraints over large scopes should supply a support_fn'''
+        doms = []
+        for v in self.scope:
+            if v is var:
+                doms.append([val])
+            else:
+                doms.append(v.cur_domain())
+        for t in itertools.product(*doms):
+            if self.check_fn(list(t)):
+                return True
         return False
 
     def tuple_is_valid(self, t):
@@ -295,6 +722,415 @@ class Constraint:
     def __str__(self):
         return("{}({})".format(self.name,[var.name for var in self.scope]))
 
+class ConstraintStats:
+    '''Counters of the work done on one constraint during search, kept
+       in constraint.stats while instrumentation is on'''
+
+    def __init__(self):
+        self.revisions = 0      #propagator passes over the constraint
+        self.support_checks = 0 #values whose support was checked
+        self.tuples_scanned = 0 #tuples looked at: support masks tested
+                                #by Compact-Table, graph edges and partial
+                                #sums by the global constraints
+        self.prunings = 0       #values pruned because of it
+        self.wipeouts = 0       #domain wipeouts it caused
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+class AllDiffConstraint(Constraint):
+    '''All-different constraint over its scope, kept without a table.
+
+       Supports are found with Regin's algorithm: a maximum matching
+       between the variables and their current domain values, then a
+       value is supported iff its edge is in the matching, lies on an
+       alternating cycle (both ends in the same strongly connected
+       component) or on an alternating path from a free value. Cost is
+       in the number of variable/value edges, not in the n! permutations
+       a table would hold.'''
+
+    def __init__(self, name, scope):
+        Constraint.__init__(self, name, scope)
+        self.check_fn = self.all_different
+
+    def all_different(self, vals):
+        return len(set(vals)) == len(vals)
+
+    def has_support(self, var, val):
+        if not var in self.scope:
+            return False
+        return (self.scope.index(var), val) in self.supported_pairs()
+
+    def find_unsupported(self):
+        supported = self.supported_pairs()
+        unsupported = []
+        n = 0
+        for i, var in enumerate(self.scope):
+            dom = var.cur_domain()
+            n += len(dom)
+            for val in dom:
+                if not (i, val) in supported:
+                    unsupported.append((var, val))
+        if self.stats is not None:
+            #every value checked, every variable/value edge of the graph
+            self.stats.support_checks += n
+            self.stats.tuples_scanned += n
+        return unsupported
+
+    def supported_pairs(self):
+        '''Internal routine. Return the set of (scope index, value) pairs
+           that belong to some maximum matching covering every variable
+           (empty if there is no such matching).'''
+        doms = [var.cur_domain() for var in self.scope]
+        n = len(doms)
+
+        #maximum matching by augmenting paths. var_match[i] is the value
+        #matched to variable i, val_match[val] the variable matched to val
+        var_match = [None] * n
+        val_match = dict()
+
+        def augment(i, seen):
+            for val in doms[i]:
+                if val in seen:
+                    continue
+                seen.add(val)
+                if not val in val_match or augment(val_match[val], seen):
+                    var_match[i] = val
+                    val_match[val] = i
+                    return True
+            return False
+
+        for i in range(n):
+            if not augment(i, set()):
+                return set()
+
+        #Directed graph: matching edges go variable -> value, the others
+        #value -> variable. Nodes are ('x', i) and ('v', val).
+        succ = dict()
+        for i in range(n):
+            succ[('x', i)] = [('v', var_match[i])]
+            for val in doms[i]:
+                if val != var_match[i]:
+                    succ.setdefault(('v', val), []).append(('x', i))
+                else:
+                    succ.setdefault(('v', val), [])
+
+        #everything reachable from a free (unmatched) value
+        stack = [node for node in succ
+                 if node[0] == 'v' and not node[1] in val_match]
+        reached = set(stack)
+        while stack:
+            node = stack.pop()
+            for nxt in succ[node]:
+                if not nxt in reached:
+                    reached.add(nxt)
+                    stack.append(nxt)
+
+        component = strongly_connected_components(succ)
+
+        supported = set()
+        for i in range(n):
+            for val in doms[i]:
+                if (val == var_match[i] or ('v', val) in reached or
+                    component[('x', i)] == component[('v', val)]):
+                    supported.add((i, val))
+        return supported
+
+class SumConstraint(Constraint):
+    '''Linear sum constraint: the (integer) values of the variables in
+       the scope must add up to total. Kept without a table.
+
+       During a search the min/max of every variable's current domain
+       and their sums lo and hi are kept up to date by the variables'
+       domain change hook (see watch), in O(1) per change plus a pass
+       over the changed domain; undoing the trail goes through the same
+       hook, so they are restored on backtracking too. The hook is only
+       set while the search is attached (BT.detach_trail removes it),
+       outside a search every revision computes them afresh. If total is out of lo..hi nothing
+       is supported. If every domain is an interval, bounds reasoning is
+       exact: a value is supported iff it is within the slack lo and hi
+       leave, so a revision is O(scope) and prunes nothing in the common
+       case. Otherwise the sums each variable's neighbours can still
+       reach are kept as bitsets (bit k set iff sum k is reachable),
+       built as prefix and suffix running sums, so the values that
+       cannot reach total are pruned exactly (GAC) with word-level
+       shifts instead of enumerating tuples.'''
+
+    def __init__(self, name, scope, total):
+        Constraint.__init__(self, name, scope)
+        self.total = total
+        self.check_fn = self.sums_to_total
+        #bounds state, set up by watch on the first revision: positions
+        #maps each variable to its scope indices, mins/maxs are None for
+        #an empty domain, n_empty/n_holes count the empty domains and
+        #the ones that are not intervals. watching is True while the
+        #variables report their changes, i.e. the state is up to date.
+        self.watching = False
+        self.positions = None
+        self.mins = None
+        self.maxs = None
+        self.holes = None
+        self.lo = 0
+        self.hi = 0
+        self.n_empty = 0
+        self.n_holes = 0
+
+    def sums_to_total(self, vals):
+        return sum(vals) == self.total
+
+    def has_support(self, var, val):
+        if not var.in_cur_domain(val):
+            return False
+        #reachable sums of the other variables, offset by their min sum
+        reach = 1
+        lo = 0
+        for v in self.scope:
+            if v is var:
+                continue
+            dom = v.cur_domain()
+            if not dom:
+                return False
+            m = min(dom)
+            lo += m
+            reach = shifted_sums(reach, dom, m)
+        need = self.total - val - lo
+        return need >= 0 and (reach >> need) & 1 == 1
+
+    def watch(self):
+        '''Internal routine. Compute the bounds of every variable and,
+           if they are in a search (they have a trail), register for
+           their domain changes until unwatch'''
+        n = len(self.scope)
+        self.positions = dict()
+        self.mins = [None] * n
+        self.maxs = [None] * n
+        self.holes = [False] * n
+        self.lo = self.hi = 0
+        self.n_empty = n
+        self.n_holes = 0
+        for i, var in enumerate(self.scope):
+            self.positions.setdefault(var, []).append(i)
+            self.set_bounds(i, var.cur_domain())
+        if not self.scope or self.scope[0].trail is None:
+            return
+        for var in self.positions:
+            if var.watchers is None:
+                var.watchers = []
+            var.watchers.append(self)
+        self.watching = True
+
+    def unwatch(self):
+        '''Stop following the domain changes of the variables (called
+           by BT.detach_trail when the search is over)'''
+        if not self.watching:
+            return
+        for var in self.positions:
+            var.watchers.remove(self)
+            if not var.watchers:
+                var.watchers = None
+        self.watching = False
+
+    def domain_changed(self, var):
+        '''Called by var after its current domain or assignment changed'''
+        dom = var.cur_domain()
+        for i in self.positions[var]:
+            self.set_bounds(i, dom)
+
+    def set_bounds(self, i, dom):
+        '''Internal routine. Make dom the domain of scope[i] in the
+           bounds state'''
+        if self.mins[i] is None:
+            self.n_empty -= 1
+        else:
+            self.lo -= self.mins[i]
+            self.hi -= self.maxs[i]
+        if self.holes[i]:
+            self.n_holes -= 1
+        if dom:
+            m = min(dom)
+            M = max(dom)
+            self.mins[i] = m
+            self.maxs[i] = M
+            self.lo += m
+            self.hi += M
+            self.holes[i] = len(dom) != M - m + 1
+            if self.holes[i]:
+                self.n_holes += 1
+        else:
+            self.mins[i] = self.maxs[i] = None
+            self.holes[i] = False
+            self.n_empty += 1
+
+    def find_unsupported(self):
+        if not self.watching:
+            self.watch()
+        total = self.total
+        lo = self.lo
+        hi = self.hi
+        if self.n_empty or not lo <= total <= hi:
+            #some variable has been wiped out or total is out of reach,
+            #nothing is supported
+            if self.stats is not None:
+                self.stats.support_checks += len(self.scope)
+                self.stats.tuples_scanned += len(self.scope)
+            return [(var, val) for var in self.scope for val in var.cur_domain()]
+
+        mins = self.mins
+        maxs = self.maxs
+        if not self.n_holes:
+            #interval domains: the others can make up every sum between
+            #their bounds, so val is supported iff it is within the slack
+            slack_lo = total - lo
+            slack_hi = hi - total
+            if self.stats is not None:
+                #one bounds test per variable
+                self.stats.support_checks += len(self.scope)
+                self.stats.tuples_scanned += len(self.scope)
+            unsupported = []
+            for i, var in enumerate(self.scope):
+                if maxs[i] - mins[i] <= slack_lo and maxs[i] - mins[i] <= slack_hi:
+                    continue
+                top = mins[i] + slack_lo
+                bottom = maxs[i] - slack_hi
+                for val in var.cur_domain():
+                    if val > top or val < bottom:
+                        unsupported.append((var, val))
+            return unsupported
+
+        doms = [var.cur_domain() for var in self.scope]
+        n = len(doms)
+        if self.stats is not None:
+            #every value checked, added to the prefix and suffix sums
+            n_vals = 0
+            for dom in doms:
+                n_vals += len(dom)
+            self.stats.support_checks += n_vals
+            self.stats.tuples_scanned += 2 * n_vals
+
+        #prefix[i]/suffix[i] are the reachable sums of variables before i
+        #/from i on (offset by their min sums)
+        prefix = [1] * (n + 1)
+        suffix = [1] * (n + 1)
+        for i in range(n):
+            prefix[i+1] = shifted_sums(prefix[i], doms[i], mins[i])
+        for i in range(n - 1, -1, -1):
+            suffix[i] = shifted_sums(suffix[i+1], doms[i], mins[i])
+
+        unsupported = []
+        for i, var in enumerate(self.scope):
+            #sums the others can make up: prefix[i] + suffix[i+1], only
+            #the ones that still leave room for a value of var are kept
+            others_lo = lo - mins[i]
+            window = (1 << (self.total - lo + 1)) - 1
+            others = 0
+            pre = prefix[i]
+            k = 0
+            while pre:
+                if pre & 1:
+                    others |= (suffix[i+1] << k) & window
+                pre >>= 1
+                k += 1
+            for val in doms[i]:
+                need = self.total - val - others_lo
+                if need < 0 or (others >> need) & 1 == 0:
+                    unsupported.append((var, val))
+        return unsupported
+
+def shifted_sums(reach, dom, base):
+    '''Add a variable with domain dom to the reachable sums bitset reach
+       (sums offset so that base, the smallest value of dom, is bit 0).'''
+    new = 0
+    for d in dom:
+        new |= reach << (d - base)
+    return new
+
+def strongly_connected_components(succ):
+    '''Tarjan's algorithm (iterative). succ maps every node to a list of
+       successor nodes. Returns a dict mapping each node to the number of
+       its strongly connected component.'''
+    index = dict()
+    low = dict()
+    component = dict()
+    on_stack = set()
+    stack = []
+    counter = 0
+    n_comps = 0
+    for root in succ:
+        if root in index:
+            continue
+        work = [(root, 0)]
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, k = work[-1]
+            if k < len(succ[node]):
+                work[-1] = (node, k + 1)
+                nxt = succ[node][k]
+                if not nxt in index:
+                    index[nxt] = low[nxt] = counter
+                    counter += 1
+                    stack.append(nxt)
+                    on_stack.add(nxt)
+                    work.append((nxt, 0))
+                elif nxt in on_stack:
+                    low[node] = min(low[node], index[nxt])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    while True:
+                        top = stack.pop()
+                        on_stack.discard(top)
+                        component[top] = n_comps
+                        if top == node:
+                            break
+                    n_comps += 1
+    return component
+
+class NogoodConstraint(Constraint):
+    '''Nogood: the variables of the scope cannot all take their values
+       in vals together. Learned by backjumping search (see
+       BT.learn_nogood). A value is unsupported iff it is the one of its
+       variable and every other variable is down to its own value, so a
+       revision is one pass over the scope that usually stops at the
+       first variable with other values left.'''
+
+    def __init__(self, name, scope, vals):
+        Constraint.__init__(self, name, scope)
+        self.vals = list(vals)
+        self.check_fn = self.not_all_equal
+        self.hits = 0   #prunings and failures caused, for eviction
+
+    def not_all_equal(self, vals):
+        return list(vals) != self.vals
+
+    def has_support(self, var, val):
+        if not var.in_cur_domain(val):
+            return False
+        return not (var, val) in self.find_unsupported()
+
+    def find_unsupported(self):
+        if self.stats is not None:
+            self.stats.support_checks += 1
+            self.stats.tuples_scanned += 1
+        open_pair = None
+        for var, val in zip(self.scope, self.vals):
+            if not var.in_cur_domain(val):
+                return []
+            if var.cur_domain_size() > 1:
+                if open_pair is not None:
+                    return []
+                open_pair = (var, val)
+        self.hits += 1
+        if open_pair is not None:
+            return [open_pair]
+        #every variable is down to its value: nothing is supported
+        return list(zip(self.scope, self.vals))
+
 class CSP:
     '''Class for packing up a set of variables into a CSP problem.
        Contains various utility routines for accessing the problem.
@@ -303,12 +1139,14 @@ class CSP:
 
     def __init__(self, name, vars=[]):
         '''create a CSP object. Specify a name (a string) and 
-           optionally a set of variables'''
+           optionally a set of variables.'''
 
         self.name = name
         self.vars = []
         self.cons = []
         self.vars_to_cons = dict()
+        self.nDuplicateCons = 0 #constraints dropped as redundant
+        self.nMergedCons = 0    #constraints merged into an earlier one
         for v in vars:
             self.add_var(v)
 
@@ -325,17 +1163,76 @@ class CSP:
 
     def add_constraint(self,c):
         '''Add constraint to CSP. Note that all variables in the 
-           constraints scope must already have been added to the CSP'''
-        if not type(c) is Constraint:
+           constraints scope must already have been added to the CSP.
+           (see normalize for merging constraints over the same
+           variables)'''
+        if not isinstance(c, Constraint):
             print("Trying to add non constraint ", c, " to CSP object")
         else:
             for v in c.scope:
                 if not v in self.vars_to_cons:
                     print("Trying to add constraint ", c, " with unknown variables to CSP object")
                     return
+            for v in c.scope:
                 self.vars_to_cons[v].append(c)
             self.cons.append(c)
 
+    def remove_constraint(self, c):
+        '''Remove constraint c, added before, from the CSP'''
+        self.cons.remove(c)
+        for v in c.scope:
+            self.vars_to_cons[v].remove(c)
+
+    def replace_constraint(self, old, new):
+        '''Internal routine. Put constraint new, over the same variables
+           as old, in old's place'''
+        self.cons[self.cons.index(old)] = new
+        for v in old.scope:
+            cons = self.vars_to_cons[v]
+            cons[cons.index(old)] = new
+
+    def normalize(self):
+        '''Merge the table constraints over the same variables (in any
+           order) into one. Of each such group the first constraint added
+           stays if every other one allows all its tuples (e.g. they are
+           duplicates), otherwise it is replaced by a new constraint
+           whose table holds the tuples satisfying all of them. Either
+           way search sees one constraint where there were several (see
+           nDuplicateCons and nMergedCons). The constraint objects are
+           not changed, so call this once their tables are complete
+           (e.g. at the end of building a model). Constraints given by
+           check functions are left as they are.'''
+        groups = dict()     #frozenset of scope -> table constraints
+        for c in self.cons:
+            if c.check_fn is None:
+                key = frozenset(c.scope)
+                if len(key) == len(c.scope) and key:
+                    groups.setdefault(key, []).append(c)
+        for group in groups.values():
+            if len(group) < 2:
+                continue
+            first = group[0]
+            kept = set(first.sat_tuples)
+            for c in group[1:]:
+                #position in c's scope of each variable of first's scope
+                perm = [c.scope.index(v) for v in first.scope]
+                tuples = set(tuple([t[i] for i in perm]) for t in c.sat_tuples)
+                if kept <= tuples:
+                    #c allows everything kept so far
+                    self.nDuplicateCons += 1
+                else:
+                    kept &= tuples
+                    self.nMergedCons += 1
+                self.remove_constraint(c)
+            if len(kept) < len(first.sat_tuples):
+                merged = Constraint(first.name, first.scope)
+                merged.add_satisfying_tuples([t for t in first.sat_tuples if t in kept])
+                self.replace_constraint(first, merged)
+
+    def print_cons_stats(self):
+        print("CSP {} has {} constraints, {} duplicates dropped and {} merged".format(
+            self.name, len(self.cons), self.nDuplicateCons, self.nMergedCons))
+
     def get_all_cons(self):
         '''return list of all constraints in the CSP'''
         return self.cons
@@ -364,6 +1261,203 @@ class CSP:
 # Backtracking Routine                                 #
 ########################################################
 
+#statuses of a SearchResult
+SOLVED = 'solved'
+UNSAT = 'unsat'
+TIMEOUT = 'timeout'
+LIMIT = 'limit'
+CANCELLED = 'cancelled'
+RESTART = 'restart'     #internal, a run of a restart search hit its cutoff
+
+class SearchResult:
+    '''Outcome of BT.bt_search. status is SOLVED, UNSAT (there is no
+       solution) or why the search was stopped first: TIMEOUT (the
+       deadline passed), LIMIT (max_decisions reached) or CANCELLED.
+       solution is the tuple of values of csp.get_all_vars() if SOLVED,
+       else None.'''
+
+    def __init__(self, status, solution, nDecisions, nPrunings, cpu_time, wall_time,
+                 nRestarts=0, nBackjumps=0, nNogoods=0, var_order='mrv',
+                 nFailures=0):
+        self.status = status
+        self.solution = solution
+        self.nDecisions = nDecisions
+        self.nPrunings = nPrunings
+        self.cpu_time = cpu_time
+        self.wall_time = wall_time
+        self.nRestarts = nRestarts
+        self.nBackjumps = nBackjumps
+        self.nNogoods = nNogoods
+        self.var_order = var_order  #name of the variable ordering used
+        self.nFailures = nFailures  #assignments whose propagation failed
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return "SearchResult({}, {} decisions, {} prunings, {:.4f}s cpu)".format(
+            self.status, self.nDecisions, self.nPrunings, self.cpu_time)
+
+def luby(i):
+    '''i-th term (from 1) of the Luby sequence 1, 1, 2, 1, 1, 2, 4, ...'''
+    while True:
+        k = i.bit_length()
+        if i == (1 << k) - 1:
+            return 1 << (k - 1)
+        i -= (1 << (k - 1)) - 1
+
+def luby_cutoffs(base=100):
+    '''Restart schedule (see BT.bt_search): base times the Luby
+       sequence, in decisions'''
+    i = 1
+    while True:
+        yield base * luby(i)
+        i += 1
+
+def geometric_cutoffs(base=100, factor=1.5):
+    '''Restart schedule (see BT.bt_search): base, base*factor,
+       base*factor**2, ... decisions'''
+    cutoff = base
+    while True:
+        yield int(cutoff)
+        cutoff *= factor
+
+class Trail:
+    '''Solver owned record of state changes made during search.
+
+       Objects (e.g. Variables) save their old state with save(obj,
+       state) before they change it. mark() starts a new choice point
+       and returns the trail height, undo(height) pops every entry
+       above that height (newest first) calling obj.restore_state(state)
+       so search can go back to the choice point in time proportional to
+       the changes made since.
+
+       The stamp changes on every mark/undo. An object only needs to
+       save itself once per stamp since the oldest saved state is the
+       one undo puts back.'''
+
+    #stamps are never reused, not even by different trails
+    stamps = itertools.count(1)
+
+    def __init__(self):
+        self.entries = []
+        self.stamp = next(Trail.stamps)
+
+    def mark(self):
+        '''Start a new choice point, return the height to undo to'''
+        self.stamp = next(Trail.stamps)
+        return len(self.entries)
+
+    def save(self, obj, state):
+        '''Record state so obj.restore_state(state) is called on undo'''
+        self.entries.append((obj, state))
+
+    def undo(self, height):
+        '''Restore everything saved since the trail was at height'''
+        entries = self.entries
+        while len(entries) > height:
+            obj, state = entries.pop()
+            obj.restore_state(state)
+        self.stamp = next(Trail.stamps)
+
+    def height(self):
+        return len(self.entries)
+
+class Culprits:
+    '''Why the values pruned by a backjumping search are gone: for every
+       variable the bitmask of the search levels whose assignments
+       caused its prunings (bit j stands for the variable assigned at
+       depth j, prunings of the initial propagation set no bit). Changes
+       are saved on the search trail so that backtracking restores them
+       with the domains.'''
+
+    def __init__(self, trail):
+        self.trail = trail
+        self.masks = dict()
+
+    def get(self, var):
+        return self.masks.get(var, 0)
+
+    def add(self, var, mask):
+        '''The levels in mask caused a pruning of var'''
+        old = self.masks.get(var, 0)
+        if mask & ~old:
+            self.trail.save(self, (var, old))
+            self.masks[var] = old | mask
+
+    def restore_state(self, state):
+        '''Called by Trail.undo'''
+        var, mask = state
+        self.masks[var] = mask
+
+class MRVHeap:
+    '''Unassigned variables ordered by current domain size, for MRV
+       variable selection in O(log n) instead of a scan of all of them.
+
+       Variables hold a reference to the heap (mrv_index) and call
+       update whenever their current domain changes. That only marks
+       them dirty, the next extract pushes one new (size, seq, var)
+       entry per dirty variable, however many values it lost or got
+       back. Old entries are not removed but skipped when they surface:
+       an entry is live only if its var is still in the heap with the
+       same seq and its size is still current. Ties
+       are broken by seq, the order in which variables were (re)added,
+       so the choice is the same as scanning a list of unassigned
+       variables in that order.
+
+       If priority is given the variables are ordered by priority(var)
+       instead of their domain size (e.g. a tuple of the size and tie
+       breakers). It must only change when the domain changes, while
+       the variable is not in the heap, or be reported with update.'''
+
+    def __init__(self, vars=[], priority=None):
+        self.heap = []
+        self.seq = dict()   #var -> seq number of the vars in the heap
+        self.count = 0
+        self.dirty = set()  #vars whose size may have changed
+        self.priority = priority
+        for var in vars:
+            self.add(var)
+
+    def key(self, var):
+        '''Internal routine. Current ordering key of var'''
+        if self.priority is None:
+            return var.cur_domain_size()
+        return self.priority(var)
+
+    def add(self, var):
+        '''Add (an unassigned) var to the heap'''
+        self.seq[var] = self.count
+        heapq.heappush(self.heap, (self.key(var), self.count, var))
+        self.count += 1
+
+    def update(self, var):
+        '''var's domain size may have changed'''
+        self.dirty.add(var)
+
+    def extract(self):
+        '''Remove and return the var with the smallest current domain
+           (None if the heap is empty)'''
+        heap = self.heap
+        if self.dirty:
+            for var in self.dirty:
+                seq = self.seq.get(var)
+                if seq is not None:
+                    heapq.heappush(heap, (self.key(var), seq, var))
+            self.dirty.clear()
+        while heap:
+            key, seq, var = heapq.heappop(heap)
+            if self.seq.get(var) == seq and key == self.key(var):
+                del self.seq[var]
+                return var
+        return None
+
+    def __len__(self):
+        return len(self.seq)
+
+    def __repr__(self):
+        return("MRVHeap({})".format(list(self.seq)))
+
 class BT:
     '''use a class to encapsulate things like statistics
        and bookeeping for pruning/unpruning variabel domains
@@ -383,6 +1477,99 @@ class BT:
         unasgn_vars = list() #used to track unassigned variables
         self.TRACE = False
         self.runtime = 0
+        self.trail = Trail() #records domain changes so they can be undone
+        self.stack = []      #choice points of the search (see bt_leaves)
+        self.search_id = 0   #number of searches started
+        self.listeners = []  #SearchListeners told about search events
+        self.set_limits()
+        self.rng = None      #random.Random of a randomized search, else None
+        self.var_weights = dict() #var -> failures, learned by randomized search
+        self.nRestarts = 0
+        self.backjump = False #conflict directed backjumping (see bt_search)
+        self.culprits = None  #Culprits of the prunings of a backjumping search
+        self.levels = dict()  #var -> search level, for the assigned vars
+        self.nogoods = []     #NogoodConstraints learned, added to the CSP
+        self.max_nogoods = 1000     #nogoods kept at most
+        self.max_nogood_size = 10   #longer ones are not recorded
+        self.nBackjumps = 0   #backtracks that skipped levels
+        self.nNogoods = 0     #nogoods learned
+        self.var_order = VarOrder() #variable ordering strategy (see bt_search)
+        self.nFailures = 0    #assignments whose propagation failed
+
+    def add_listener(self, listener):
+        '''Have listener (a SearchListener) told about the events of the
+           following searches. With no listener the search pays a single
+           test per event.'''
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def enable_constraint_stats(self):
+        '''Start keeping a fresh ConstraintStats in every constraint of
+           the CSP (see constraint_stats)'''
+        for c in self.csp.get_all_cons():
+            c.stats = ConstraintStats()
+
+    def disable_constraint_stats(self):
+        '''Stop keeping constraint stats'''
+        for c in self.csp.get_all_cons():
+            c.stats = None
+
+    def constraint_stats(self):
+        '''List of (constraint, ConstraintStats) for the constraints that
+           keep stats, the most revised first'''
+        stats = [(c, c.stats) for c in self.csp.get_all_cons() if c.stats is not None]
+        stats.sort(key=lambda cs: (-cs[1].revisions, -cs[1].support_checks))
+        return stats
+
+    def print_constraint_stats(self, top=10):
+        '''Print the counters of the top most revised constraints'''
+        print("{:>10} {:>10} {:>10} {:>9} {:>9}  constraint".format(
+            "revisions", "supports", "tuples", "prunings", "wipeouts"))
+        for c, st in self.constraint_stats()[:top]:
+            print("{:>10} {:>10} {:>10} {:>9} {:>9}  {} {}".format(
+                st.revisions, st.support_checks, st.tuples_scanned,
+                st.prunings, st.wipeouts, type(c).__name__, c))
+
+    #decisions between two checks of the deadline and cancel token
+    CHECK_INTERVAL = 32
+
+    def set_limits(self, deadline=None, max_decisions=None, cancel=None):
+        '''Internal routine. Limits of the next search: deadline is a
+           time.time() value, max_decisions a number of decisions and
+           cancel any object with an is_set() method (e.g. a
+           threading.Event or multiprocessing.Event). None means no
+           limit.'''
+        self.deadline = deadline
+        self.max_decisions = max_decisions
+        self.cancel = cancel
+        self.stop_reason = None
+        self.run_limit = None   #nDecisions ending the current restart run
+        if deadline is None and max_decisions is None and cancel is None:
+            self.next_check = float('inf')
+        else:
+            self.next_check = 0
+
+    def check_limits(self):
+        '''Internal routine. Called by bt_leaves when nDecisions reaches
+           next_check. Returns the reason to stop (TIMEOUT, LIMIT,
+           CANCELLED) or None, and sets the next check.'''
+        n = self.nDecisions
+        if self.max_decisions is not None and n >= self.max_decisions:
+            return LIMIT
+        if self.cancel is not None and self.cancel.is_set():
+            return CANCELLED
+        if self.deadline is not None and time.time() >= self.deadline:
+            return TIMEOUT
+        if self.run_limit is not None and n >= self.run_limit:
+            return RESTART
+        self.next_check = n + self.CHECK_INTERVAL
+        if self.max_decisions is not None:
+            self.next_check = min(self.next_check, self.max_decisions)
+        if self.run_limit is not None:
+            self.next_check = min(self.next_check, self.run_limit)
+        return None
 
     def trace_on(self):
         '''Turn search trace on'''
@@ -397,6 +1584,10 @@ class BT:
         '''Initialize counters'''
         self.nDecisions = 0
         self.nPrunings = 0
+        self.nRestarts = 0
+        self.nBackjumps = 0
+        self.nNogoods = 0
+        self.nFailures = 0
         self.runtime = 0
 
     def print_stats(self):
@@ -409,6 +1600,32 @@ class BT:
         for var, val in prunings:
             var.unprune_value(val)
 
+    def attach_trail(self):
+        '''Make all variables record their domain changes on our trail
+           and report their size changes to the unassigned vars heap'''
+        explain = None
+        if self.backjump:
+            self.culprits = Culprits(self.trail)
+            explain = self.explain_pruning
+        for var in self.csp.vars:
+            var.trail = self.trail
+            var.trail_stamp = -1
+            var.mrv_index = self.unasgn_vars
+            var.explain = explain
+
+    def detach_trail(self):
+        '''Stop recording domain changes (and unregister the constraints
+           following them, see SumConstraint.watch), and empty the trail'''
+        for var in self.csp.vars:
+            var.trail = None
+            var.mrv_index = None
+            var.explain = None
+            if var.watchers is not None:
+                for c in list(var.watchers):
+                    c.unwatch()
+        self.trail = Trail()
+        self.culprits = None
+
     def restore_all_variable_domains(self):
         '''Reinitialize all variable domains'''
         for var in self.csp.vars:
@@ -417,28 +1634,18 @@ class BT:
             var.restore_curdom()
 
     def extractMRVvar(self):
-        '''Remove variable with minimum sized cur domain from list of
-           unassigned vars. Would be faster to use heap...but this is
-           not production code.
+        '''Remove variable with minimum sized cur domain from the
+           unassigned vars (an MRVHeap kept up to date by the variables)
         '''
-
-        md = -1
-        mv = None
-        for v in self.unasgn_vars:
-            if md < 0:
-                md = v.cur_domain_size()
-                mv = v
-            elif v.cur_domain_size() < md:
-                md = v.cur_domain_size()
-                mv = v
-        self.unasgn_vars.remove(mv)
-        return mv
+        return self.unasgn_vars.extract()
 
     def restoreUnasgnVar(self, var):
-        '''Add variable back to list of unassigned vars'''
-        self.unasgn_vars.append(var)
+        '''Add variable back to the unassigned vars'''
+        self.unasgn_vars.add(var)
         
-    def bt_search(self,propagator):
+    def bt_search(self, propagator, timeout=None, deadline=None,
+                  max_decisions=None, cancel=None, restarts=None, seed=None,
+                  backjump=False, var_order=None):
         '''Try to solve the CSP using specified propagator routine
 
            propagator == a function with the following template
@@ -464,86 +1671,801 @@ class BT:
 
            The list of variable values pairs are all of the values
            the propagator pruned (using the variable's prune_value method). 
-           bt_search NEEDS to know this in order to correctly restore these 
-           values when it undoes a variable assignment.
+           bt_search uses it for its statistics and trace. Restoring the
+           values when it undoes a variable assignment is done with the
+           trail: every variable saves its current domain on the trail
+           before its first change after a choice point, and
+           backtracking pops the trail back to that choice point.
 
            NOTE propagator SHOULD NOT prune a value that has already been 
-           pruned! Nor should it prune a value twice'''
+           pruned! Nor should it prune a value twice
+
+           The search stops early after timeout seconds, at the wall
+           clock time deadline (a time.time() value), after
+           max_decisions decisions, or once cancel.is_set() (see
+           set_limits). The deadline and cancel are checked every
+           CHECK_INTERVAL decisions.
+
+           Given a seed the search is randomized (see randomize): ties
+           of MRV and the order of the values are decided by a
+           random.Random(seed), so the same seed gives the same search.
+           Given restarts, a schedule of decision cutoffs (an iterable
+           like luby_cutoffs() or geometric_cutoffs(), or 'luby' or
+           'geometric' for those with their defaults), the randomized
+           search (seed 0 if none is given) starts again from scratch
+           every time a run has made its cutoff of decisions. The
+           failure counts of the variables are kept from run to run and
+           break MRV ties before the random order, so later runs branch
+           first on the variables that failed most. The last run, once
+           the cutoffs exceed what the search needs, is complete.
+
+           With backjump the search is conflict directed: every pruning
+           is explained by the levels of the assignments that caused it
+           (see explain_pruning), and once all the values of a variable
+           have failed the search goes back to the deepest level among
+           their causes instead of the previous one, skipping the
+           levels in between. Unless they are all the levels above (the
+           current path, never seen again without restarts) the
+           assignments at those levels are recorded as a nogood, a
+           NogoodConstraint the propagator
+           enforces like the other constraints until the search ends
+           (restarts keep them). At most max_nogoods nogoods of at most
+           max_nogood_size variables are kept, the less active half is
+           dropped when there are too many. The propagator must give
+           the constraint responsible for each pruning (see
+           Variable.prune_value), a pruning without one is taken to
+           depend on all the assignments made.
+
+           var_order picks the next variable to assign: MRV (the
+           default), 'dom/wdeg', 'impact' or any VarOrder (see
+           VAR_ORDERS). The conflict driven ones learn from the failures
+           of the search, also across restarts.
+
+           The outcome is printed, and returned as a SearchResult. If
+           the search was stopped early no variable is left assigned.'''
 
         self.clear_stats()
         stime = time.process_time()
+        swall = time.time()
+        if timeout is not None:
+            if deadline is None or swall + timeout < deadline:
+                deadline = swall + timeout
+        self.set_limits(deadline, max_decisions, cancel)
+        if restarts is not None and seed is None:
+            seed = 0
+        self.randomize(seed)
+        self.backjump = backjump
+        self.forget_nogoods()
+        self.use_var_order(var_order)
+        try:
+            if restarts is None:
+                status, prunings = self.start_search(propagator)
 
-        self.restore_all_variable_domains()
-        
-        self.unasgn_vars = []
-        for v in self.csp.vars:
-            if not v.is_assigned():
-                self.unasgn_vars.append(v)
-
-        status, prunings = propagator(self.csp) #initial propagate no assigned variables.
-        self.nPrunings = self.nPrunings + len(prunings)
-
-        if self.TRACE:
-            print(len(self.unasgn_vars), " unassigned variables at start of search")
-            print("Root Prunings: ", prunings)
-
-        if status == False:
-            print("CSP{} detected contradiction at root".format(
-                self.csp.name))
+                if self.TRACE:
+                    print(len(self.unasgn_vars), " unassigned variables at start of search")
+                    print("Root Prunings: ", prunings)
+
+                if status == False:
+                    print("CSP{} detected contradiction at root".format(
+                        self.csp.name))
+                else:
+                    status = self.bt_loop(propagator)   #now do the search
+            else:
+                status = self.restart_loop(propagator, restarts)
+        finally:
+            self.release_var_order()
+
+        if self.stop_reason is not None:
+            self.end_search(keep_solution=False)
+            print("CSP {} search stopped ({}) after {} decisions".format(
+                self.csp.name, self.stop_reason, self.nDecisions))
+            result_status = self.stop_reason
+            solution = None
         else:
-            status = self.bt_recurse(propagator, 1)   #now do recursive search
-
-
-        self.restoreValues(prunings)
-        if status == False:
+            self.end_search()
+            result_status = SOLVED if status else UNSAT
+            solution = None
+            if status:
+                solution = tuple([var.get_assigned_value() for var in self.csp.vars])
+        if result_status == UNSAT:
             print("CSP{} unsolved. Has no solutions".format(self.csp.name))
-        if status == True:
+        if result_status == SOLVED:
             print("CSP {} solved. CPU Time used = {}".format(self.csp.name,
                                                              time.process_time() - stime))
             self.csp.print_soln()
 
+        self.forget_nogoods()
         print("bt_search finished")
         self.print_stats()
+        if self.nRestarts:
+            print("Search restarted {} times".format(self.nRestarts))
+        if backjump:
+            print("Search backjumped {} times and learned {} nogoods".format(
+                self.nBackjumps, self.nNogoods))
+        if var_order is not None:
+            print("Variable ordering {}: {} failed assignments".format(
+                self.var_order.name, self.nFailures))
+        self.randomize(None)
+        self.backjump = False
+        return SearchResult(result_status, solution, self.nDecisions, self.nPrunings,
+                            time.process_time() - stime, time.time() - swall,
+                            self.nRestarts, self.nBackjumps, self.nNogoods,
+                            self.var_order.name, self.nFailures)
+
+    def randomize(self, seed):
+        '''Internal routine. Make the following searches randomized with
+           random.Random(seed), or deterministic again if seed is None.
+           Forgets the learned variable weights.'''
+        self.rng = None if seed is None else random.Random(seed)
+        self.var_weights = dict()
+
+    def randomized_priority(self, var):
+        '''Internal routine. Key of var in a randomized search: the key
+           of the variable ordering first (for MRV the domain size), then
+           most failures, then a random order drawn at the start of the
+           run'''
+        return (self.var_order.key(var), -self.var_weights.get(var, 0),
+                self.tiebreak[var])
+
+    def use_var_order(self, var_order):
+        '''Internal routine. Make var_order (a VarOrder, the name of one
+           in VAR_ORDERS, or None for MRV) the variable ordering of the
+           following search, learning afresh'''
+        if var_order is None:
+            var_order = 'mrv'
+        if isinstance(var_order, str):
+            if not var_order in VAR_ORDERS:
+                raise ValueError("unknown variable ordering {}".format(var_order))
+            var_order = VAR_ORDERS[var_order]()
+        if self.var_order in self.listeners:
+            self.listeners.remove(self.var_order)
+        self.var_order = var_order
+        var_order.reset(self)
+        if var_order.listens:
+            self.listeners.append(var_order)
+
+    def release_var_order(self):
+        '''Internal routine. Stop telling the variable ordering about
+           search events once the search is over (it is only used by the
+           search that picked it)'''
+        if self.var_order in self.listeners:
+            self.listeners.remove(self.var_order)
+
+    def restart_loop(self, propagator, restarts, fixed=None):
+        '''Internal routine. Search in runs limited by the cutoffs of the
+           restarts schedule (see bt_search), each run starting with the
+           (var, value) pairs of fixed. Returns True if a solution
+           was found, False otherwise (no solution, or stop_reason says
+           why the search stopped). The search is left as bt_loop leaves
+           it.'''
+        if restarts == 'luby':
+            restarts = luby_cutoffs()
+        elif restarts == 'geometric':
+            restarts = geometric_cutoffs()
+        for cutoff in restarts:
+            self.run_limit = self.nDecisions + cutoff
+            self.next_check = min(self.next_check, self.run_limit)
+            status, prunings = self.start_search(propagator, fixed)
+            if not status:
+                #the root does not depend on the run
+                return False
+            if self.bt_loop(propagator):
+                return True
+            if self.stop_reason != RESTART:
+                return False
+            self.stop_reason = None
+            self.end_search(keep_solution=False)
+            self.nRestarts += 1
+            for listener in self.listeners:
+                listener.on_restart(self, self.nRestarts)
+        #the schedule ran out
+        self.stop_reason = LIMIT
+        return False
 
-    def bt_recurse(self, propagator, level):
-        '''Return true if found solution. False if still need to search.
-           If top level returns false--> no solution'''
-
-        if self.TRACE:
-            print('  ' * level, "bt_recurse level ", level)
-           
-        if not self.unasgn_vars:
-            #all variables assigned
-            return True
+    def explain_pruning(self, var, val, reason):
+        '''Internal routine. Variable.explain hook of a backjumping
+           search: val was pruned from var because of reason, a
+           constraint over var (None if unknown). The culprits of the
+           pruning are the levels of the other variables of the scope
+           that are assigned and the culprits of the values pruned from
+           the others, whose current domains made val unsupported.'''
+        if reason is None:
+            mask = (1 << (len(self.stack) + 1)) - 2
         else:
-            var = self.extractMRVvar()
-            if self.TRACE:
-                print('  ' * level, "bt_recurse var = ", var)
-
-            for val in var.cur_domain():
-
-                if self.TRACE:
-                    print('  ' * level, "bt_recurse trying", var, "=", val)
+            mask = 0
+            levels = self.levels
+            culprits = self.culprits
+            for w in reason.scope:
+                if w is not var:
+                    if w.assignedValue is not None:
+                        mask |= 1 << levels[w]
+                    else:
+                        mask |= culprits.get(w)
+        self.culprits.add(var, mask)
+
+    def failure_culprits(self, prunings, level):
+        '''Internal routine. Bitmask of the levels that caused the
+           propagation at level, which returned prunings, to fail: the
+           culprits of the variable it wiped out, all the levels if there
+           is none (e.g. a constraint check failed)'''
+        if prunings:
+            var = prunings[-1][0]
+            if var.cur_domain_size() == 0:
+                return self.culprits.get(var)
+        return (1 << (level + 1)) - 2
+
+    def backjump_from(self, conflict, level):
+        '''Internal routine. Every value of the variable at level (whose
+           choice point was just popped) failed because of the
+           assignments at the levels in the conflict bitmask. Records
+           them as a nogood if they are not all the levels above (or the
+           search restarts), undoes the levels above the deepest of
+           them and adds the others to its conflict. Returns False if no
+           assignment is to blame, i.e. there is no solution.'''
+        stack = self.stack
+        target = conflict.bit_length() - 1
+        if target <= 0:
+            self.unwind(0)
+            return False
+        #a conflict on every level above is the current path, which the
+        #search never comes back to unless it restarts
+        if popcount(conflict) < level - 1 or self.run_limit is not None:
+            self.learn_nogood(conflict)
+        if target < level - 1:
+            self.nBackjumps += 1
+            self.unwind(target)
+        frame = stack[target - 1]
+        if frame[4] is not None:
+            frame[4] |= conflict & ~(1 << target)
+        return True
 
-                var.assign(val)
-                self.nDecisions = self.nDecisions+1
+    def unwind(self, depth):
+        '''Internal routine. Undo the assignments of the levels above
+           depth, all of them assigned, and pop their choice points'''
+        stack = self.stack
+        if len(stack) > depth:
+            self.trail.undo(stack[depth][3])
+        while len(stack) > depth:
+            var = stack.pop()[0]
+            var.unassign()
+            self.restoreUnasgnVar(var)
+            for listener in self.listeners:
+                listener.on_backtrack(self, var, len(stack) + 1)
+
+    def learn_nogood(self, conflict):
+        '''Internal routine. Record the current assignments at the
+           levels in the conflict bitmask as a NogoodConstraint of the
+           CSP, unless there are more than max_nogood_size of them. When
+           max_nogoods are kept the ones that pruned least (the older
+           on ties) are dropped down to half of that, and the activity
+           of the others is halved so that recent activity counts more.'''
+        if popcount(conflict) > self.max_nogood_size or self.max_nogoods <= 0:
+            return
+        if len(self.nogoods) >= self.max_nogoods:
+            ranked = sorted(range(len(self.nogoods)),
+                            key=lambda i: (self.nogoods[i].hits, i))
+            n_drop = len(ranked) - self.max_nogoods // 2
+            for i in ranked[:n_drop]:
+                c = self.nogoods[i]
+                self.csp.remove_constraint(c)
+                #the weighted degree of dom/wdeg changes
+                for var in c.scope:
+                    if var.mrv_index is not None:
+                        var.mrv_index.update(var)
+            self.nogoods = [self.nogoods[i] for i in sorted(ranked[n_drop:])]
+            for c in self.nogoods:
+                c.hits //= 2
+        scope = []
+        vals = []
+        while conflict:
+            low = conflict & -conflict
+            var = self.stack[low.bit_length() - 2][0]
+            scope.append(var)
+            vals.append(var.assignedValue)
+            conflict ^= low
+        c = NogoodConstraint("Nogood", scope, vals)
+        self.csp.add_constraint(c)
+        self.nogoods.append(c)
+        self.nNogoods += 1
+
+    def forget_nogoods(self):
+        '''Internal routine. Remove the learned nogoods from the CSP'''
+        for c in self.nogoods:
+            self.csp.remove_constraint(c)
+        self.nogoods = []
+
+    def solutions(self, propagator, limit=None, fixed=None, deadline=None,
+                  max_decisions=None, cancel=None, backjump=False, var_order=None,
+                  seed=None, restarts=None):
+        '''Generator of the solutions of the CSP, found with propagator
+           (see bt_search). Each solution is yielded as soon as it is
+           found, as a tuple of values in the order of
+           csp.get_all_vars(). Stops after limit solutions if limit is
+           not None. Only solutions with the (var, value) pairs in fixed
+           (if given) are searched for. Nothing is printed, the
+           statistics are kept as for bt_search. When the generator
+           finishes or is closed the variables are unassigned and their
+           domains restored. deadline, max_decisions and cancel limit
+           the search as for bt_search: if the generator ends because of
+           them stop_reason says why (it is None otherwise). backjump,
+           var_order, seed and restarts are as for bt_search; a search
+           with restarts only yields the first solution it finds.'''
+        self.clear_stats()
+        self.set_limits(deadline, max_decisions, cancel)
+        if restarts is not None and seed is None:
+            seed = 0
+        self.randomize(seed)
+        self.backjump = backjump
+        self.forget_nogoods()
+        self.use_var_order(var_order)
+        if restarts is None:
+            status, prunings = self.start_search(propagator, fixed)
+        else:
+            status = self.restart_loop(propagator, restarts, fixed)
+        search = self.search_id
+        try:
+            if status:
+                vars = self.csp.vars
+                if restarts is not None:
+                    #the last run stopped at its first solution
+                    yield tuple([var.assignedValue for var in vars])
+                    return
+                n = 0
+                for _ in self.bt_leaves(propagator):
+                    yield tuple([var.assignedValue for var in vars])
+                    n += 1
+                    if limit is not None and n >= limit:
+                        break
+        finally:
+            if self.search_id == search:
+                self.end_search(keep_solution=False)
+                self.forget_nogoods()
+                self.randomize(None)
+                self.release_var_order()
+
+    def count_solutions(self, propagator, limit=None, fixed=None, deadline=None,
+                        max_decisions=None, cancel=None, backjump=False,
+                        var_order=None):
+        '''Return the number of solutions of the CSP (counting at most
+           limit if limit is not None, and only those with the (var,
+           value) pairs in fixed if given) without building them. With
+           deadline, max_decisions or cancel (see solutions) the count
+           is only a lower bound if stop_reason is not None. backjump and
+           var_order are as for bt_search.'''
+        self.clear_stats()
+        self.set_limits(deadline, max_decisions, cancel)
+        self.backjump = backjump
+        self.forget_nogoods()
+        self.use_var_order(var_order)
+        try:
+            status, prunings = self.start_search(propagator, fixed)
+            n = 0
+            if status:
+                for _ in self.bt_leaves(propagator):
+                    n += 1
+                    if limit is not None and n >= limit:
+                        break
+            self.end_search(keep_solution=False)
+            self.forget_nogoods()
+        finally:
+            self.release_var_order()
+        return n
 
-                status, prunings = propagator(self.csp, var)
-                self.nPrunings = self.nPrunings + len(prunings)
+    def subproblems(self, propagator, depth, fixed=None):
+        '''Generator that splits the search into subproblems by assigning
+           the (MRV) variables in every way propagator does not rule out,
+           until depth of them had a choice (more than one value left
+           when they were picked); the forced ones on the way are
+           assigned for free. Yields each subproblem as a list of (index
+           of the variable in csp.get_all_vars(), value) pairs, which can
+           be solved independently (see the fixed argument of solutions
+           and count_solutions). Together they cover all solutions.
+           Given fixed, a subproblem in the same format, only that one is
+           split further and every part starts with it.'''
+        self.clear_stats()
+        self.set_limits()
+        self.backjump = False
+        self.forget_nogoods()
+        self.use_var_order(None)
+        fixed = list(fixed or [])
+        vars = self.csp.vars
+        status, prunings = self.start_search(propagator,
+                                             [(vars[i], val) for i, val in fixed])
+        search = self.search_id
+        index = dict((var, i) for i, var in enumerate(vars))
+        fixed_vars = set(i for i, val in fixed)
+        try:
+            if status:
+                for _ in self.bt_leaves(propagator, depth):
+                    yield fixed + [(index[frame[0]], frame[0].assignedValue)
+                                   for frame in self.stack
+                                   if not index[frame[0]] in fixed_vars]
+        finally:
+            if self.search_id == search:
+                self.end_search(keep_solution=False)
+
+    def start_search(self, propagator, fixed=None):
+        '''Internal routine. Reset the variables, set up the unassigned
+           vars heap and the trail, restrict the domains of the variables
+           in fixed (a list of (var, value) pairs) to their value, and do
+           the initial propagation. Returns what the propagator returned
+           (False without propagating if a fixed value is not in its
+           variable's domain).'''
+        self.search_id += 1
+        self.restore_all_variable_domains()
+        
+        if self.rng is not None:
+            self.tiebreak = dict((v, self.rng.random()) for v in self.csp.vars)
+            self.unasgn_vars = MRVHeap(priority=self.randomized_priority)
+        elif type(self.var_order) is VarOrder:
+            self.unasgn_vars = MRVHeap()
+        else:
+            self.unasgn_vars = MRVHeap(priority=self.var_order.key)
+        for v in self.csp.vars:
+            if not v.is_assigned():
+                self.unasgn_vars.add(v)
+
+        self.attach_trail()
+        self.stack = []
+        self.root = self.trail.mark()
+
+        if fixed:
+            for var, val in fixed:
+                for d in var.cur_domain():
+                    if d != val:
+                        var.prune_value(d)
+                if var.cur_domain_size() == 0:
+                    return False, []
+
+        if self.listeners:
+            stime = time.perf_counter()
+        status, prunings = propagator(self.csp) #initial propagate no assigned variables.
+        self.nPrunings = self.nPrunings + len(prunings)
+        if self.listeners:
+            seconds = time.perf_counter() - stime
+            for listener in self.listeners:
+                listener.on_propagate(self, propagator, None, status, prunings, seconds)
+                if not status:
+                    listener.on_wipeout(self, None, 0)
+        return status, prunings
+
+    def end_search(self, keep_solution=True):
+        '''Internal routine. Undo all the domain changes of the search
+           and stop recording them. The variables keep their assigned
+           values only if keep_solution is True.'''
+        self.trail.undo(self.root)
+        if not keep_solution:
+            for frame in self.stack:
+                if frame[0].is_assigned():
+                    frame[0].unassign()
+            self.stack = []
+        self.detach_trail()
+
+    def bt_loop(self, propagator):
+        '''Return true if found solution. False if there is none.'''
+        for _ in self.bt_leaves(propagator):
+            return True
+        return False
 
-                if self.TRACE:
-                    print('  ' * level, "bt_recurse prop status = ", status)
-                    print('  ' * level, "bt_recurse prop pruned = ", prunings)
+    def bt_leaves(self, propagator, max_depth=None):
+        '''Generator that yields (None) every time all variables are
+           assigned, i.e., at every solution. When resumed it carries on
+           searching for the next one. If max_depth is given it also
+           yields (and does not go deeper) when max_depth of the assigned
+           variables had more than one value left when they were picked
+           (forced variables do not count).
+
+           Non-recursive search: self.stack holds one choice point per
+           assigned variable, a list [var, values to try, index of the
+           next one, trail height before the current one (None if var
+           is not assigned), conflict]. Search depth is not limited by
+           the Python stack and each level costs a list instead of a
+           frame. In a backjumping search the conflict is the bitmask of
+           the levels that caused the values of var tried so far to
+           fail (None once a solution was found below, from then on the
+           level is left chronologically), see bt_search.'''
+
+        self.stack = stack = []
+        trail = self.trail
+        listeners = self.listeners
+        backjump = self.backjump
+        levels = self.levels
+        if not self.unasgn_vars or max_depth == 0:
+            #all variables assigned
+            for listener in listeners:
+                listener.on_solution(self, 0)
+            yield
+            return
+        rng = self.rng
+        var = self.extractMRVvar()
+        vals = var.cur_domain()
+        if rng is not None:
+            rng.shuffle(vals)
+        stack.append([var, vals, 0, None, 0])
+        for listener in listeners:
+            listener.on_node(self, var, 1)
+        if self.TRACE:
+            print('  ', "bt_search var = ", var)
 
-                if status:
-                    if self.bt_recurse(propagator, level+1):
-                        return True
+        while stack:
+            frame = stack[-1]
+            var, vals, i, height, conflict = frame
+            level = len(stack)
 
+            if height is not None:
+                #the previous value of var failed, undo it
                 if self.TRACE:
-                    print('  ' * level, "bt_recurse restoring ", prunings)
-                self.restoreValues(prunings)
+                    print('  ' * level, "bt_search restoring ", var)
+                trail.undo(height)
                 var.unassign()
+                frame[3] = None
+
+            if i == len(vals):
+                #all values of var failed, backtrack
+                stack.pop()
+                self.restoreUnasgnVar(var)
+                for listener in listeners:
+                    listener.on_backtrack(self, var, level)
+                if backjump and conflict is not None:
+                    #the values pruned before var was picked failed too
+                    if not self.backjump_from(conflict | self.culprits.get(var), level):
+                        return
+                continue
+
+            if self.nDecisions >= self.next_check:
+                reason = self.check_limits()
+                if reason is not None:
+                    self.stop_reason = reason
+                    return
 
-            self.restoreUnasgnVar(var)
-            return False
+            val = vals[i]
+            frame[2] = i + 1
+            if self.TRACE:
+                print('  ' * level, "bt_search trying", var, "=", val)
+
+            frame[3] = trail.mark()
+            if backjump:
+                levels[var] = level
+            var.assign(val)
+            self.nDecisions = self.nDecisions+1
+
+            if listeners:
+                for listener in listeners:
+                    listener.on_assign(self, var, val, level)
+                stime = time.perf_counter()
+                status, prunings = propagator(self.csp, var)
+                seconds = time.perf_counter() - stime
+                for listener in listeners:
+                    listener.on_propagate(self, propagator, var, status, prunings, seconds)
+                    if not status:
+                        listener.on_wipeout(self, var, level)
+            else:
+                status, prunings = propagator(self.csp, var)
+            self.nPrunings = self.nPrunings + len(prunings)
 
+            if self.TRACE:
+                print('  ' * level, "bt_search prop status = ", status)
+                print('  ' * level, "bt_search prop pruned = ", prunings)
+
+            if status:
+                if not self.unasgn_vars or (
+                        max_depth is not None and
+                        sum(1 for f in stack if len(f[1]) > 1) == max_depth):
+                    #all variables assigned, var's value is undone
+                    #(and the next one tried) if we get resumed
+                    if backjump:
+                        for f in stack:
+                            f[4] = None
+                    for listener in listeners:
+                        listener.on_solution(self, level)
+                    yield
+                    continue
+                var = self.extractMRVvar()
+                vals = var.cur_domain()
+                if rng is not None:
+                    rng.shuffle(vals)
+                stack.append([var, vals, 0, None, 0])
+                for listener in listeners:
+                    listener.on_node(self, var, level + 1)
+                if self.TRACE:
+                    print('  ' * (level+1), "bt_search level ", level+1)
+                    print('  ' * (level+1), "bt_search var = ", var)
+            else:
+                self.nFailures += 1
+                if backjump and frame[4] is not None:
+                    frame[4] |= self.failure_culprits(prunings, level) & ~(1 << level)
+                if rng is not None:
+                    #learned for the following runs: var's value failed
+                    self.var_weights[var] = self.var_weights.get(var, 0) + 1
+
+class SearchListener:
+    '''Base class of the listeners of BT search events (see
+       BT.add_listener). The methods do nothing, subclasses override the
+       ones they need. depth is the number of variables assigned,
+       counting the one concerned.'''
+
+    def on_node(self, solver, var, depth):
+        '''var was picked as the next variable to assign'''
+
+    def on_assign(self, solver, var, val, depth):
+        '''var was assigned val'''
+
+    def on_propagate(self, solver, propagator, var, status, prunings, seconds):
+        '''propagator returned (status, prunings) in seconds after var
+           was assigned (var is None for the initial propagation)'''
+
+    def on_wipeout(self, solver, var, depth):
+        '''propagation after assigning var failed (var is None for the
+           initial propagation)'''
+
+    def on_backtrack(self, solver, var, depth):
+        '''every value of var failed, search goes back up'''
+
+    def on_solution(self, solver, depth):
+        '''all variables are assigned (or the depth limit of a split is
+           reached)'''
+
+    def on_restart(self, solver, n):
+        '''the n-th restart of a restart search is starting'''
+
+class SearchProfile(SearchListener):
+    '''Listener counting search events, with the calls, time, prunings
+       and wipeouts of each propagator (keyed by its name)'''
+
+    def __init__(self):
+        self.nodes = 0
+        self.assignments = 0
+        self.wipeouts = 0
+        self.backtracks = 0
+        self.solutions = 0
+        self.restarts = 0
+        self.max_depth = 0
+        self.propagators = dict()
+
+    def on_node(self, solver, var, depth):
+        self.nodes += 1
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def on_assign(self, solver, var, val, depth):
+        self.assignments += 1
+
+    def on_propagate(self, solver, propagator, var, status, prunings, seconds):
+        name = getattr(propagator, '__name__', repr(propagator))
+        prof = self.propagators.get(name)
+        if prof is None:
+            prof = self.propagators[name] = {'calls': 0, 'seconds': 0.0,
+                                             'prunings': 0, 'wipeouts': 0}
+        prof['calls'] += 1
+        prof['seconds'] += seconds
+        prof['prunings'] += len(prunings)
+        if not status:
+            prof['wipeouts'] += 1
+
+    def on_wipeout(self, solver, var, depth):
+        self.wipeouts += 1
+
+    def on_backtrack(self, solver, var, depth):
+        self.backtracks += 1
+
+    def on_solution(self, solver, depth):
+        self.solutions += 1
+
+    def on_restart(self, solver, n):
+        self.restarts += 1
+
+    def print_profile(self):
+        print("{} nodes, {} assignments, {} wipeouts, {} backtracks, {} solutions, {} restarts, max depth {}".format(
+            self.nodes, self.assignments, self.wipeouts, self.backtracks,
+            self.solutions, self.restarts, self.max_depth))
+        for name, prof in sorted(self.propagators.items()):
+            print("  {}: {} calls, {:.4f}s, {} prunings, {} wipeouts".format(
+                name, prof['calls'], prof['seconds'], prof['prunings'],
+                prof['wipeouts']))
+
+class VarOrder(SearchListener):
+    '''Variable ordering strategy of BT (see bt_search): the unassigned
+       variable with the smallest key(var) is assigned next, ties going
+       to the one (re)added to the unassigned variables first. This
+       class is MRV, the key is the current domain size.
+
+       Strategies that learn from the search do it as SearchListeners
+       (listens is True), added to the listeners of the solver while
+       they are in use. A key may change with the current domain of the
+       variable and with what is learned while the variable is
+       assigned, any other change must be reported to the heap with
+       var.mrv_index.update(var) (see MRVHeap).'''
+
+    name = 'mrv'
+    listens = False
+
+    def reset(self, solver):
+        '''Forget what was learned, at the start of every search of
+           solver (the runs of a restart search carry on learning)'''
+
+    def key(self, var):
+        return var.cur_domain_size()
+
+class DomWdegOrder(VarOrder):
+    '''dom/wdeg: smallest ratio of the current domain size to the
+       weighted degree, the sum of the weights of the constraints over
+       the variable. Every constraint starts the search with weight 1
+       and the propagators bump it each time it wipes out a domain (see
+       Constraint.bump_weight), so the search is drawn to the variables
+       of the constraints that fail most. The degree counts all the
+       constraints over the variable, not only those with other
+       unassigned variables, so that it only changes on wipeouts.'''
+
+    name = 'dom/wdeg'
+
+    def reset(self, solver):
+        for c in solver.csp.get_all_cons():
+            c.weight = 1
+        self.cons = solver.csp.vars_to_cons
+
+    def key(self, var):
+        wdeg = 0
+        for c in self.cons[var]:
+            wdeg += c.weight
+        return var.cur_domain_size() / wdeg if wdeg else float('inf')
+
+class ImpactOrder(VarOrder):
+    '''Impact based ordering: the impact of an assignment is the share
+       of the search space (the product of the domain sizes) that it
+       and its propagation removed, 1 if the propagation failed. The
+       impacts of the values tried so far are averaged, and the variable
+       whose current values leave the least search space, the smallest
+       sum of (1 - impact) over them, is assigned first. Values not yet
+       tried count with the average impact of the variable's tried
+       values (0 before any), so the ordering starts out as MRV.'''
+
+    name = 'impact'
+    listens = True
+
+    def reset(self, solver):
+        self.impacts = dict()       #(var, val) -> [sum of impacts, count]
+        self.var_impacts = dict()   #var -> [sum of impacts, count]
+        self.size = 1               #domain size of the var being assigned
+
+    def key(self, var):
+        impacts = self.impacts
+        tried = self.var_impacts.get(var)
+        default = tried[0] / tried[1] if tried else 0.0
+        left = 0.0
+        for val in var.cur_domain():
+            total = impacts.get((var, val))
+            left += 1.0 - (total[0] / total[1] if total else default)
+        return left
+
+    def on_assign(self, solver, var, val, depth):
+        #the assignment leaves the current domain bitmask as it was
+        self.size = popcount(var.curdom)
+
+    def on_propagate(self, solver, propagator, var, status, prunings, seconds):
+        if var is None:
+            return
+        if status:
+            #log of the search space before over after
+            removed = math.log(self.size)
+            counts = dict()
+            for w, val in prunings:
+                counts[w] = counts.get(w, 0) + 1
+            for w, k in counts.items():
+                left = w.cur_domain_size()
+                removed += math.log((left + k) / left)
+            impact = 1.0 - math.exp(-removed)
+        else:
+            impact = 1.0
+        for key, table in (((var, var.assignedValue), self.impacts),
+                           (var, self.var_impacts)):
+            total = table.get(key)
+            if total is None:
+                table[key] = [impact, 1]
+            else:
+                total[0] += impact
+                total[1] += 1
+
+#variable ordering strategies by name (see BT.bt_search)
+VAR_ORDERS = {'mrv': VarOrder,
+              'dom/wdeg': DomWdegOrder,
+              'impact': ImpactOrder}
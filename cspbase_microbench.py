@@ -0,0 +1,181 @@
+'''Microbenchmarks of the cspbase/propagators primitives that dominate
+   search profiles, on objects shaped like those of the Tenner models
+   (variables with the domain 0..9, the model_1 not-equal tables, the
+   column sums and row all-different constraints of board b1).
+
+   For each benchmark the operation is timed with timeit (best of
+   --repeat runs) and reported in operations per second. Its memory
+   traffic is measured with tracemalloc over a single operation: the
+   peak number of bytes it had allocated at once, and the number of
+   memory blocks it left allocated (which should be 0 for everything
+   but the operations that build a result).
+
+   Usage: python cspbase_microbench.py [name ...] [--repeat R] [--json]
+   where the names select benchmarks by substring.
+'''
+
+import argparse
+import json
+import sys
+import timeit
+import tracemalloc
+
+from cspbase import Trail
+from propagators import Queue
+from tenner_csp import tenner_csp_model_1, tenner_csp_model_2, b1
+
+
+def tenner_setup():
+    '''The objects the benchmarks run on: model_1 and model_2 of b1
+       with the domains of some open cells partly pruned, as in the
+       middle of a search'''
+    csp1, vars1 = tenner_csp_model_1(b1)
+    csp2, vars2 = tenner_csp_model_2(b1)
+    for var_array in (vars1, vars2):
+        for row in var_array:
+            for var in row:
+                if var.domain_size() == 10:
+                    for val in (1, 4, 6, 7, 8):
+                        var.prune_value(val)
+    var = vars1[0][0]
+    neq = [c for c in csp1.get_cons_with_var(var) if len(c.scope) == 2][0]
+    cons2 = csp2.get_cons_with_var(vars2[0][0])
+    sumc = [c for c in cons2 if type(c).__name__ == 'SumConstraint'][0]
+    alldiff = [c for c in cons2 if type(c).__name__ == 'AllDiffConstraint'][0]
+    #model_2's variables record their changes on a trail as in a search,
+    #so that SumConstraint keeps its bounds up to date instead of
+    #recomputing them on every revision
+    trail = Trail()
+    for row in vars2:
+        for v in row:
+            v.trail = trail
+    #the support checks must be about variables of the constraint
+    assert var in neq.scope
+    assert vars2[0][0] in sumc.scope and vars2[0][0] in alldiff.scope
+    return {'csp1': csp1, 'csp2': csp2, 'var': var, 'full': vars1[1][0],
+            'neq': neq, 'sum': sumc, 'alldiff': alldiff,
+            'vars2': vars2}
+
+
+def benchmarks(env):
+    '''List of (name, operation) pairs, each operation a function of no
+       arguments'''
+    var = env['var']
+    full = env['full']
+    neq = env['neq']
+    sumc = env['sum']
+    alldiff = env['alldiff']
+    csp2 = env['csp2']
+    var2 = env['vars2'][0][0]
+    t = next(iter(neq.sat_tuples))
+    other = neq.scope[1]
+
+    def in_cur_domain():
+        for val in range(10):
+            var.in_cur_domain(val)
+
+    def prune_unprune():
+        full.prune_value(3)
+        full.unprune_value(3)
+
+    trail = Trail()
+
+    def prune_trailed():
+        #one choice point: a prune saved on the trail and undone by it
+        full.trail = trail
+        height = trail.mark()
+        full.prune_value(3)
+        trail.undo(height)
+        full.trail = None
+
+    def has_support_table():
+        for val in (0, 2, 3, 5, 9):
+            neq.has_support(other, val)
+
+    def has_support_sum():
+        sumc.has_support(var2, 0)
+
+    cons = csp2.get_all_cons()
+
+    def queue():
+        #the gac_enforce pattern: fill, test membership, drain
+        q = Queue()
+        for c in cons[:20]:
+            if not q.contains(c):
+                q.enqueue(c)
+        while not q.empty():
+            q.dequeue()
+
+    return [('Variable.in_cur_domain x10', in_cur_domain),
+            ('Variable.cur_domain', var.cur_domain),
+            ('Variable.cur_domain_size', var.cur_domain_size),
+            ('Variable.prune_value+unprune_value', prune_unprune),
+            ('Variable.prune_value trailed', prune_trailed),
+            ('Constraint.has_support table x5', has_support_table),
+            ('Constraint.tuple_is_valid', lambda: neq.tuple_is_valid(t)),
+            ('Constraint.find_unsupported table', neq.find_unsupported),
+            ('SumConstraint.has_support', has_support_sum),
+            ('SumConstraint.find_unsupported', sumc.find_unsupported),
+            ('AllDiffConstraint.find_unsupported', alldiff.find_unsupported),
+            ('CSP.get_cons_with_var', lambda: csp2.get_cons_with_var(var2)),
+            ('Queue fill/contains/drain x20', queue)]
+
+
+def traced(op):
+    '''Run op once under tracemalloc, return (peak bytes, blocks left)'''
+    tracemalloc.start()
+    try:
+        start_size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        op()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    #leave out the tracing machinery's own allocations
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__),
+              tracemalloc.Filter(False, __file__)]
+    before = before.filter_traces(ignore)
+    after = after.filter_traces(ignore)
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'lineno')
+                 if stat.count_diff > 0)
+    return peak - start_size, blocks
+
+
+def measure(op, repeat):
+    '''Return (ops per second, peak bytes, blocks left) for op. The
+       memory figures are net of those of an operation doing nothing.'''
+    timer = timeit.Timer(op)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat, number))
+    op()    #warm up caches before tracing
+    base_peak, base_blocks = traced(lambda: None)
+    peak, blocks = traced(op)
+    return number / best, max(0, peak - base_peak), max(0, blocks - base_blocks)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Microbenchmarks of cspbase primitives.")
+    parser.add_argument('names', nargs='*', help="run only benchmarks containing these")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help="print JSON")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, op in benchmarks(tenner_setup()):
+        if args.names and not any(n in name for n in args.names):
+            continue
+        ops, peak, blocks = measure(op, args.repeat)
+        results.append({'name': name, 'ops_per_sec': ops,
+                        'peak_bytes': peak, 'blocks_left': blocks})
+        if not args.json:
+            print("{:40} {:>14,.0f} ops/s {:>8} bytes peak {:>4} blocks left".format(
+                name, ops, peak, blocks))
+    if args.json:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+'''Parallel search: split the search tree of a CSP into independent
+   subproblems and solve them on a process pool.
+
+   The CSP is propagated at the root and the first few MRV variables that
+   have a choice are assigned in every way the propagator does not rule
+   out (see BT.subproblems), one level at a time, each level splitting
+   the parts of the previous one. Each resulting partial assignment is a
+   subproblem that a worker solves with BT on its own copy of the CSP.
+
+   As for portfolio.py the problem is given as build, args where
+   build(*args) returns a CSP object (or a tuple whose first element is
+   the CSP, like the tenner_csp models). It is built once here for the
+   split and once per worker process. build, args and the propagator
+   must be picklable (module level functions are). Subproblems and
+   solutions refer to variables by their index in csp.get_all_vars(),
+   so build must create them in the same order every time.
+
+   parallel_bt_search supports three modes:
+      'first'  return the first solution found (or None)
+      'all'    return the list of all solutions
+      'count'  return the number of solutions
+'''
+
+import concurrent.futures
+import multiprocessing
+import os
+
+from cspbase import BT
+
+
+def build_csp(build, args):
+    csp = build(*args)
+    if isinstance(csp, tuple):
+        csp = csp[0]
+    return csp
+
+
+#per worker process state: the stop event (set by init_worker) and the
+#last problem built
+worker_stop = None
+worker_problem = None
+worker_csp = None
+
+
+def init_worker(stop):
+    global worker_stop
+    worker_stop = stop
+
+
+def solve_subproblem(build, args, propagator, fixed, mode):
+    '''Worker: solve one subproblem. Returns (result, decisions,
+       prunings) where result is a list of solutions (at most one in
+       'first' mode) or a count in 'count' mode'''
+    #the CSP is built once per worker process and reused, every search
+    #starts by resetting the domains anyway
+    global worker_problem, worker_csp
+    if worker_problem != (build, args):
+        worker_csp = build_csp(build, args)
+        worker_problem = (build, args)
+    csp = worker_csp
+
+    solver = BT(csp)
+    vars = csp.get_all_vars()
+    fixed = [(vars[i], val) for i, val in fixed]
+    #the search checks the stop event every few decisions and gives up
+    #once it is set
+    if mode == 'count':
+        result = solver.count_solutions(propagator, fixed=fixed, cancel=worker_stop)
+    else:
+        limit = 1 if mode == 'first' else None
+        result = list(solver.solutions(propagator, limit, fixed, cancel=worker_stop))
+    if solver.stop_reason is not None:
+        result = 0 if mode == 'count' else []
+    return result, solver.nDecisions, solver.nPrunings
+
+
+#default limit on the number of split levels: the parent process does
+#all of the split on its own, so it must stay a small part of the search
+MAX_SPLIT_DEPTH = 6
+
+
+def split(build, args, propagator, n_target, max_depth=MAX_SPLIT_DEPTH):
+    '''Return (subproblems, decisions, prunings), going one choice
+       deeper at a time by splitting every part of the previous level
+       until there are at least n_target parts, or max_depth levels
+       were split, or a level adds no parts (e.g. every part is already
+       a complete assignment). decisions and prunings are the work done
+       by the split itself.'''
+    csp = build_csp(build, args)
+    solver = BT(csp)
+    n_vars = len(csp.get_all_vars())
+    parts = list(solver.subproblems(propagator, 0))
+    decisions, prunings = solver.nDecisions, solver.nPrunings
+    depth = 0
+    while parts and len(parts) < n_target:
+        if max_depth is not None and depth >= max_depth:
+            break
+        if all(len(part) == n_vars for part in parts):
+            break
+        deeper = []
+        for part in parts:
+            deeper.extend(solver.subproblems(propagator, 1, part))
+            decisions += solver.nDecisions
+            prunings += solver.nPrunings
+        depth += 1
+        grew = len(deeper) > len(parts)
+        parts = deeper
+        if not grew:
+            break
+    return parts, decisions, prunings
+
+
+def parallel_bt_search(build, args, propagator, mode='first', max_workers=None,
+                       split_depth=None, subproblems_per_worker=8):
+    '''Solve the CSP returned by build(*args) with propagator, splitting
+       the search across a pool of max_workers processes (default: one
+       per core). mode is 'first', 'all' or 'count' (see module doc).
+       The search is split into about subproblems_per_worker
+       subproblems per worker (going at most MAX_SPLIT_DEPTH choices
+       deep) unless split_depth fixes the number of choices to make.
+
+       Returns (result, stats) where stats is a dict with the number of
+       subproblems and the total decisions and prunings of the split
+       and the workers (split_decisions and split_prunings are the ones
+       of the split alone).
+       Solutions are tuples of values in the order of
+       csp.get_all_vars(). In 'all' mode they are grouped by subproblem,
+       in the order of the split, so the result does not depend on
+       which worker finishes first.'''
+    if not mode in ('first', 'all', 'count'):
+        raise ValueError("mode must be 'first', 'all' or 'count'")
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    if split_depth is None:
+        parts, decisions, prunings = split(build, args, propagator,
+                                           max_workers * subproblems_per_worker)
+    else:
+        parts, decisions, prunings = split(build, args, propagator,
+                                           float('inf'), split_depth)
+
+    stats = {'subproblems': len(parts), 'decisions': decisions,
+             'prunings': prunings, 'split_decisions': decisions,
+             'split_prunings': prunings}
+    results = [None] * len(parts)
+    stop = multiprocessing.Event()
+    with concurrent.futures.ProcessPoolExecutor(max_workers, initializer=init_worker,
+                                                initargs=(stop,)) as pool:
+        futures = dict()
+        for i, fixed in enumerate(parts):
+            futures[pool.submit(solve_subproblem, build, args, propagator,
+                                fixed, mode)] = i
+        for future in concurrent.futures.as_completed(futures):
+            result, decisions, prunings = future.result()
+            stats['decisions'] += decisions
+            stats['prunings'] += prunings
+            results[futures[future]] = result
+            if mode == 'first' and result:
+                #tell the running workers to stop, drop the queued ones
+                stop.set()
+                for f in futures:
+                    f.cancel()
+                return result[0], stats
+
+    if mode == 'first':
+        return None, stats
+    if mode == 'count':
+        return sum(results), stats
+    return [solution for part in results for solution in part], stats
+
+
+if __name__ == "__main__":
+    import time
+    from propagators import prop_GAC
+    from tenner_csp import tenner_csp_model_2, b1
+
+    for mode in ['first', 'count']:
+        start_time = time.time()
+        result, stats = parallel_bt_search(tenner_csp_model_2, (b1,), prop_GAC, mode)
+        print(mode, result, stats)
+        print("--- %s seconds for parallel %s ---" % (time.time() - start_time, mode))
@@ -0,0 +1,168 @@
+'''Portfolio solving: race several solver configurations on the same
+   problem in separate processes and keep the first answer.
+
+   Which model/propagator/heuristic combination is fastest varies by
+   orders of magnitude from board to board, so running a few of them at
+   once turns the worst case into (roughly) the best configuration's
+   time.
+
+   A configuration is a tuple (name, build, args, propagator, kwargs)
+   where build(*args) returns a CSP object (or a tuple whose first
+   element is the CSP, like the tenner_csp models), propagator is one of
+   the propagators of propagators.py and kwargs is a dict of keyword
+   arguments for BT.solutions picking the search strategy (var_order,
+   seed, restarts, backjump), which may be left out of the tuple.
+   Everything in a configuration must be picklable (module level
+   functions are) since the CSP is built in the worker process.
+
+   The first configuration to finish decides: a solution, or proof that
+   there is none (every configuration is a complete search). The other
+   workers are then terminated. A configuration that raises, or whose
+   worker dies without answering (e.g. killed for running out of
+   memory), has failed and the others go on.
+'''
+
+import multiprocessing
+import os
+import queue
+import time
+
+from cspbase import BT
+from propagators import prop_FC, prop_GAC
+from tenner_csp import tenner_csp_model_1, tenner_csp_model_2
+
+#seconds between checks that the running workers are still alive
+POLL_INTERVAL = 0.1
+
+
+def run_config(index, build, args, propagator, kwargs, results):
+    '''Worker process: build the CSP, search for one solution with
+       BT.solutions(propagator, **kwargs) and put (index, solution or
+       None, stats) on the results queue'''
+    try:
+        stime = time.process_time()
+        csp = build(*args)
+        if isinstance(csp, tuple):
+            csp = csp[0]
+        build_time = time.process_time() - stime
+        solver = BT(csp)
+        solution = next(solver.solutions(propagator, limit=1, **kwargs), None)
+        stats = {'decisions': solver.nDecisions,
+                 'prunings': solver.nPrunings,
+                 'restarts': solver.nRestarts,
+                 'build_cpu': build_time,
+                 'cpu': time.process_time() - stime}
+        results.put((index, solution, stats, None))
+    except Exception as e:
+        results.put((index, None, None, repr(e)))
+
+
+def solve_portfolio(configs, timeout=None, max_workers=None):
+    '''Race configs (see module doc), at most max_workers at a time
+       (default: one per core). Returns (name, solution, stats):
+       name is the configuration that answered first and solution its
+       tuple of values (in the order of csp.get_all_vars()), or None if
+       it proved there is no solution. If no configuration answered
+       within timeout seconds (or all of them failed) name is None.'''
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    results = multiprocessing.Queue()
+    running = dict()
+    waiting = list(enumerate(configs))
+    deadline = None if timeout is None else time.time() + timeout
+    answer = (None, None, None)
+    #workers seen to have exited: their result, if any, is read within
+    #one more poll, after that they count as failed
+    exited = set()
+
+    try:
+        while waiting or running:
+            while waiting and len(running) < max_workers:
+                index, config = waiting.pop(0)
+                name, build, args, propagator = config[:4]
+                kwargs = config[4] if len(config) > 4 else dict()
+                p = multiprocessing.Process(target=run_config,
+                                            args=(index, build, args,
+                                                  propagator, kwargs, results))
+                p.daemon = True
+                p.start()
+                running[index] = p
+
+            wait = POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    break
+            try:
+                index, solution, stats, error = results.get(timeout=wait)
+            except queue.Empty:
+                for index, p in list(running.items()):
+                    if p.exitcode is None:
+                        continue
+                    if index in exited:
+                        running.pop(index).join()
+                        print("Portfolio configuration", configs[index][0],
+                              "failed: worker exited with code", p.exitcode,
+                              "without an answer")
+                    else:
+                        exited.add(index)
+                continue
+            running.pop(index).join()
+            if error is None:
+                answer = (configs[index][0], solution, stats)
+                break
+            print("Portfolio configuration", configs[index][0],
+                  "failed:", error)
+    finally:
+        #cancel the others
+        for p in running.values():
+            p.terminate()
+        for p in running.values():
+            p.join()
+        results.close()
+    return answer
+
+
+def tenner_configs(initial_tenner_board):
+    '''The default Tenner portfolio: both models with FC and GAC and
+       MRV, and the conflict driven variable orderings and randomized
+       restarts on the more robust ones'''
+    args = (initial_tenner_board,)
+    return [("model_1 FC", tenner_csp_model_1, args, prop_FC, {}),
+            ("model_1 GAC", tenner_csp_model_1, args, prop_GAC, {}),
+            ("model_2 GAC", tenner_csp_model_2, args, prop_GAC, {}),
+            ("model_2 FC", tenner_csp_model_2, args, prop_FC, {}),
+            ("model_1 FC dom/wdeg", tenner_csp_model_1, args, prop_FC,
+             {'var_order': 'dom/wdeg'}),
+            ("model_2 GAC dom/wdeg", tenner_csp_model_2, args, prop_GAC,
+             {'var_order': 'dom/wdeg'}),
+            ("model_1 FC impact", tenner_csp_model_1, args, prop_FC,
+             {'var_order': 'impact'}),
+            ("model_2 GAC restarts", tenner_csp_model_2, args, prop_GAC,
+             {'seed': 1, 'restarts': 'luby'})]
+
+
+def solve_tenner_portfolio(initial_tenner_board, configs=None, timeout=None,
+                           max_workers=None):
+    '''Solve a Tenner board (see tenner_csp_model_1 for the format) with a
+       portfolio. Returns (name, grid, stats) as for solve_portfolio
+       except that the solution is given as a list of rows.'''
+    if configs is None:
+        configs = tenner_configs(initial_tenner_board)
+    name, solution, stats = solve_portfolio(configs, timeout, max_workers)
+    grid = None
+    if solution is not None:
+        grid = [list(solution[i:i+10]) for i in range(0, len(solution), 10)]
+    return name, grid, stats
+
+
+if __name__ == "__main__":
+    from tenner_csp import b1, b2
+
+    for b in [b1, b2]:
+        start_time = time.time()
+        name, grid, stats = solve_tenner_portfolio(b)
+        print("Solved by", name, stats)
+        for row in grid:
+            print(row)
+        print("--- %s seconds for portfolio ---" % (time.time() - start_time))
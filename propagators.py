@@ -26,7 +26,9 @@
        return is true if we can continue.
 
       The list of variable values pairs are all of the values
-      the propagator pruned (using the variable's prune_value method).
+      the propagator pruned (using the variable's prune_value method,
+      given the constraint responsible so that backjumping search can
+      tell which assignments caused the pruning).
       bt_search NEEDS to know this in order to correctly restore these
       values when it undoes a variable assignment.
 
@@ -71,7 +73,13 @@ def prop_BT(csp, newVar=None):
             vars = c.get_scope()
             for var in vars:
                 vals.append(var.get_assigned_value())
+            if c.stats is not None:
+                c.stats.revisions += 1
+                c.stats.support_checks += 1
             if not c.check(vals):
+                if c.stats is not None:
+                    c.stats.wipeouts += 1
+                c.bump_weight()
                 return False, []
     return True, []
 
@@ -139,12 +147,30 @@ def prop_FC(csp, newVar=None):
 def fc_check(C, x):
     pruned = []
     dwo = True
-    for d in x.cur_domain():
-        if C.has_support(x, d) is False:
-            x.prune_value(d)
+    #x is the only unassigned variable of C so there is nothing to search
+    #for: d is supported iff x = d with the other assignments satisfies C
+    vals = []
+    for var in C.scope:
+        vals.append(var.get_assigned_value())
+    pos = C.scope.index(x)
+    dom = x.cur_domain()
+    for d in dom:
+        vals[pos] = d
+        if not C.check(vals):
+            x.prune_value(d, C)
             pruned.append((x, d))
 
+    if C.stats is not None:
+        C.stats.revisions += 1
+        C.stats.support_checks += len(dom)
+        #one complete tuple checked per value
+        C.stats.tuples_scanned += len(dom)
+        C.stats.prunings += len(pruned)
+        if x.cur_domain_size() == 0:
+            C.stats.wipeouts += 1
+
     if x.cur_domain_size() is 0:
+        C.bump_weight()
         return dwo, pruned
     else:
         return False, pruned
@@ -186,18 +212,25 @@ def gac_enforce(csp, gac_queue):
     dwo = True
     while not gac_queue.empty():
         c = gac_queue.dequeue()
-        for V in c.get_scope():
-            for d in V.cur_domain():
-                if c.has_support(V, d) is False:  #A not found
-                    V.prune_value(d)
-                    pruned.append((V, d))
-
-                    if V.cur_domain_size() is 0:
-                        return dwo, pruned
-                    else:
-                        for c_prime in csp.get_cons_with_var(V):  #all C' s.t. V is in scope(C')
-                            if not gac_queue.contains(c_prime):  #and C' not in gac_queue
-                                gac_queue.enqueue(c_prime)  #push to gac_queue
+        if c.stats is not None:
+            c.stats.revisions += 1
+        #all (V, d) with no support (A not found). global constraints like
+        #AllDiffConstraint find these in one pass instead of per value
+        for V, d in c.find_unsupported():
+            V.prune_value(d, c)
+            pruned.append((V, d))
+            if c.stats is not None:
+                c.stats.prunings += 1
+
+            if V.cur_domain_size() is 0:
+                if c.stats is not None:
+                    c.stats.wipeouts += 1
+                c.bump_weight()
+                return dwo, pruned
+            else:
+                for c_prime in csp.get_cons_with_var(V):  #all C' s.t. V is in scope(C')
+                    if not gac_queue.contains(c_prime):  #and C' not in gac_queue
+                        gac_queue.enqueue(c_prime)  #push to gac_queue
     return False, pruned
 
 #SOURCE: http://stackoverflow.com/questions/20557440/queue-class-dequeue-and-enqueue-python
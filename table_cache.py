@@ -0,0 +1,77 @@
+'''Cache of precomputed constraint tables.
+
+   The satisfying tuples of the table constraints built by tenner_csp
+   depend only on the domains of the variables in the scope (i.e. on the
+   clues fixed on the board). The same tables therefore come up again and
+   again, across the constraints of one board and across boards.
+
+   The only tables left are the not-equal pairs of model_1's binary
+   constraints: the column sums are SumConstraints and the rows of
+   model_2 AllDiffConstraints, so there are no column (or row) tables to
+   cache any more. Those pairs are cheap to build, so the cache is kept
+   in memory only, per process.
+
+   A TableCache keeps the tables it computes, keyed by the kind of table
+   and its parameters, evicting the least recently used ones beyond
+   maxsize. Tables are returned as lists of tuples that are shared
+   between all the callers asking for the same key: they must not be
+   modified.
+'''
+
+import collections
+import itertools
+
+
+class TableCache:
+    '''In-memory LRU cache of constraint tables (see the module doc)'''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.tables = collections.OrderedDict()
+        self.clear_stats()
+
+    def clear_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        '''dict of the cache counters'''
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.tables)}
+
+    def clear(self):
+        '''Empty the cache'''
+        self.tables.clear()
+
+    def get(self, key, compute):
+        '''Return the table for key, a tuple of ints and tuples of ints
+           identifying it. If it is not in the cache it is computed as
+           compute(), an iterable of tuples, and kept.'''
+        table = self.tables.get(key)
+        if table is not None:
+            self.tables.move_to_end(key)
+            self.hits += 1
+            return table
+
+        self.misses += 1
+        table = [tuple(t) for t in compute()]
+        self.tables[key] = table
+        if self.maxsize is not None and len(self.tables) > self.maxsize:
+            self.tables.popitem(last=False)
+        return table
+
+
+#the cache used by the table builders unless they are given another one
+default_cache = TableCache()
+
+
+def not_equal_tuples(dom1, dom2, cache=None):
+    '''Pairs (a, b) with a in dom1, b in dom2 and a != b'''
+    if cache is None:
+        cache = default_cache
+    dom1 = tuple(dom1)
+    dom2 = tuple(dom2)
+
+    def compute():
+        return (t for t in itertools.product(dom1, dom2) if t[0] != t[1])
+    return cache.get(('neq', dom1, dom2), compute)
@@ -0,0 +1,206 @@
+'''Batch solving of Tenner boards.
+
+   Boards are read from a JSONL file (or stdin), one board per line,
+   either in the (n_grid, last_row) format of tenner_csp_model_1 written
+   as a JSON list
+
+       [[[6, -1, 1, 5, 7, -1, -1, -1, 3, -1], ...], [21, 26, 21, ...]]
+
+   or as an object with an optional id
+
+       {"id": "b2", "n_grid": [[6, -1, ...], ...], "last_row": [21, ...]}
+
+   They are built and solved on a process pool with a bounded number of
+   boards in flight, so memory stays flat however large the corpus is.
+   Results are streamed back, in input order or as they complete, one
+   JSON object per line:
+
+       {"id": "b2", "index": 1, "status": "solved", "solution": [[...], ...],
+        "decisions": 82, "prunings": 839, "build_cpu": 0.01, "search_cpu": 0.05}
+
+   status is "solved", "unsat" (the board has no solution), "timeout"
+   or "limit" (the search was stopped by --timeout or --max-decisions)
+   or "error" (the line could not be read or solved, see "error").
+
+   Usage: python tenner_batch.py [boards.jsonl] [-o results.jsonl]
+              [--model 1|2] [--propagator FC|GAC] [--workers N]
+              [--in-flight N] [--unordered] [--timeout S]
+              [--max-decisions N]
+'''
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+from cspbase import BT, SOLVED, UNSAT
+from propagators import prop_BT, prop_FC, prop_GAC
+from tenner_csp import tenner_csp_model_1, tenner_csp_model_2
+
+MODELS = {'1': tenner_csp_model_1, '2': tenner_csp_model_2}
+PROPAGATORS = {'BT': prop_BT, 'FC': prop_FC, 'GAC': prop_GAC}
+
+
+def read_boards(lines):
+    '''Generator of (id, board, None) for the JSONL lines given (any
+       iterable of strings, e.g. an open file). The id defaults to the
+       line number (from 0). Blank lines are skipped. A line that cannot
+       be read gives (id, None, error message) instead.'''
+    for n, line in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+        board_id = n
+        try:
+            item = json.loads(line)
+            if isinstance(item, dict):
+                board_id = item.get('id', n)
+                board = (item['n_grid'], item['last_row'])
+            else:
+                board = (item[0], item[1])
+            yield board_id, board, None
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            yield board_id, None, "bad board line {}: {}".format(n + 1, e)
+
+
+def solve_board(board, model='2', propagator='GAC', timeout=None,
+                max_decisions=None):
+    '''Build and solve one board, return its result dict (without id and
+       index, see the module doc). The search is given timeout seconds
+       of wall clock time (counted from the start of the build) and
+       max_decisions decisions if they are not None.'''
+    deadline = None if timeout is None else time.time() + timeout
+    stime = time.process_time()
+    csp, var_array = MODELS[model](board)
+    build_cpu = time.process_time() - stime
+
+    solver = BT(csp)
+    stime = time.process_time()
+    solution = next(solver.solutions(PROPAGATORS[propagator], limit=1,
+                                     deadline=deadline,
+                                     max_decisions=max_decisions), None)
+    result = {'status': solver.stop_reason or UNSAT, 'solution': None}
+    if solution is not None:
+        #csp variables are the cells in row order
+        result = {'status': SOLVED,
+                  'solution': [list(solution[i:i+10])
+                               for i in range(0, len(solution), 10)]}
+    result['decisions'] = solver.nDecisions
+    result['prunings'] = solver.nPrunings
+    result['build_cpu'] = build_cpu
+    result['search_cpu'] = time.process_time() - stime
+    return result
+
+
+def solve_boards(boards, model='2', propagator='GAC', max_workers=None,
+                 max_in_flight=None, ordered=True, timeout=None,
+                 max_decisions=None):
+    '''Generator of result dicts for the (id, board, error) items of
+       boards (see read_boards), solved on a pool of max_workers
+       processes (default: one per core). At most max_in_flight boards
+       (default: 4 per worker) are submitted and not yet yielded at any
+       time. Results come in input order if ordered, else as they
+       complete. timeout and max_decisions limit each board (see
+       solve_board).'''
+    if not model in MODELS:
+        raise ValueError("unknown model {}".format(model))
+    if not propagator in PROPAGATORS:
+        raise ValueError("unknown propagator {}".format(propagator))
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_in_flight is None:
+        max_in_flight = 4 * max_workers
+
+    boards = iter(boards)
+    pending = dict()    #future -> (index, id)
+    done = dict()       #index -> result, finished but not yet yielded
+    next_index = 0      #next result to yield when ordered
+    n_read = 0
+    exhausted = False
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+        while True:
+            while not exhausted and len(pending) + len(done) < max_in_flight:
+                item = next(boards, None)
+                if item is None:
+                    exhausted = True
+                    break
+                board_id, board, error = item
+                if error is None:
+                    future = pool.submit(solve_board, board, model, propagator,
+                                         timeout, max_decisions)
+                    pending[future] = (n_read, board_id)
+                else:
+                    done[n_read] = {'id': board_id, 'index': n_read,
+                                    'status': 'error', 'error': error}
+                n_read += 1
+
+            if not pending and not done:
+                break
+
+            if ordered:
+                ready = next_index in done
+            else:
+                ready = len(done) > 0
+            if pending and not ready:
+                finished, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    index, board_id = pending.pop(future)
+                    result = {'id': board_id, 'index': index}
+                    try:
+                        result.update(future.result())
+                    except Exception as e:
+                        result.update({'status': 'error', 'error': repr(e)})
+                    done[index] = result
+
+            if ordered:
+                while next_index in done:
+                    yield done.pop(next_index)
+                    next_index += 1
+            else:
+                for index in list(done):
+                    yield done.pop(index)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Solve a JSONL corpus of Tenner boards.")
+    parser.add_argument('input', nargs='?', default='-',
+                        help="JSONL file of boards (default: stdin)")
+    parser.add_argument('-o', '--output', default='-',
+                        help="JSONL file for the results (default: stdout)")
+    parser.add_argument('--model', choices=sorted(MODELS), default='2')
+    parser.add_argument('--propagator', choices=sorted(PROPAGATORS), default='GAC')
+    parser.add_argument('--workers', type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument('--in-flight', type=int, default=None,
+                        help="max boards in flight (default: 4 per worker)")
+    parser.add_argument('--unordered', action='store_true',
+                        help="write results as they complete, not in input order")
+    parser.add_argument('--timeout', type=float, default=None,
+                        help="seconds allowed per board")
+    parser.add_argument('--max-decisions', type=int, default=None,
+                        help="decisions allowed per board")
+    args = parser.parse_args(argv)
+
+    infile = sys.stdin if args.input == '-' else open(args.input)
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        for result in solve_boards(read_boards(infile), args.model, args.propagator,
+                                   args.workers, args.in_flight,
+                                   ordered=not args.unordered,
+                                   timeout=args.timeout,
+                                   max_decisions=args.max_decisions):
+            outfile.write(json.dumps(result) + "\n")
+            outfile.flush()
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+'''Reproducible Tenner benchmark.
+
+   Boards are generated from a seed: a random valid grid of n rows
+   (n = 3..8) is built row by row, each cell is kept as a clue with
+   probability density, and the column sums of the grid become the last
+   row, so every board has at least one solution. Each board is generated
+   from its own seed (derived from the suite seed, n, density and its
+   number), so the same board always gets the same grid whatever else is
+   in the suite.
+
+   Every board is solved with every configuration (model/propagator
+   combination, see CONFIGS). Model build and search are timed
+   separately, in wall clock and CPU time, along with the decisions,
+   prunings and peak memory (traced in a second, untimed run so that
+   tracing does not distort the times). The times are the best of
+   --repeat runs, and the table cache is emptied before every build.
+   Every search is cut off after --timeout seconds or --max-decisions
+   decisions, so the status of a run is solved, unsat, timeout or limit;
+   the totals and the comparison only count runs that completed (solved
+   or unsat).
+
+   Results are written as JSON:
+
+       {"meta": {"seed": 0, "sizes": [...], ...},
+        "results": [{"board": "n5-d0.5-0", "config": "model_2 GAC",
+                     "build_wall": ..., "build_cpu": ..., "search_wall": ...,
+                     "search_cpu": ..., "decisions": 82, "prunings": 839,
+                     "peak_memory": ..., "status": "solved",
+                     "solved": true}, ...],
+        "summary": {"model_2 GAC": {"build_cpu": ..., ...,
+                                    "runs": {"solved": 30, ...}}, ...}}
+
+   and, given a baseline (an earlier result file, run with the same
+   seed), compared with it per configuration over the boards both ran to
+   completion (same board ids). Decisions and prunings do not depend on
+   the machine, so they are the exact signal: a configuration regresses
+   as soon as either grows at all. Times are noisy (the best of --repeat
+   runs helps), so its total CPU time only counts as a regression when it
+   grows by more than the threshold (default 10%) AND by more than
+   --min-cpu-diff seconds (default 0.05), and its peak memory when it
+   grows by more than the threshold. The exit status is 1 if there is a
+   regression.
+
+   Usage: python tenner_benchmark.py [-o results.json] [--baseline old.json]
+              [--seed S] [--sizes 3 4 5] [--densities 0.4 0.6]
+              [--boards K] [--configs "model_2 GAC" ...] [--threshold 0.1]
+              [--min-cpu-diff 0.05] [--repeat R] [--timeout T] [--max-decisions D] [--no-memory]
+'''
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from cspbase import BT, SOLVED, UNSAT
+from propagators import prop_FC, prop_GAC
+from tenner_csp import tenner_csp_model_1, tenner_csp_model_2
+from tenner_numpy import tenner_array_model
+import table_cache
+
+
+def random_grid(n, rng):
+    '''A random valid Tenner grid of n rows: each row a permutation of
+       0..9 not repeating a value of the row above in a neighbouring
+       column'''
+    rows = []
+    while len(rows) < n:
+        row = list(range(10))
+        rng.shuffle(row)
+        if rows and any(row[c] in rows[-1][max(0, c - 1):c + 2] for c in range(10)):
+            continue
+        rows.append(row)
+    return rows
+
+
+def generate_board(n, density, seed):
+    '''Solvable board (in the format of tenner_csp_model_1) of n rows,
+       each cell a clue with probability density, generated from seed'''
+    rng = random.Random(seed)
+    grid = random_grid(n, rng)
+    board = [[val if rng.random() < density else -1 for val in row]
+             for row in grid]
+    last_row = [sum(row[c] for row in grid) for c in range(10)]
+    return board, last_row
+
+
+def generate_suite(seed, sizes, densities, boards_per_spec):
+    '''List of (board id, n, density, board)'''
+    suite = []
+    for n in sizes:
+        for density in densities:
+            for k in range(boards_per_spec):
+                board_id = "n{}-d{}-{}".format(n, density, k)
+                board = generate_board(n, density, "{}-{}".format(seed, board_id))
+                suite.append((board_id, n, density, board))
+    return suite
+
+
+def bt_config(model, propagator, var_order=None):
+    '''Configuration solving with model and BT with propagator (and
+       the variable ordering var_order, see BT.bt_search)'''
+    def build(board):
+        return BT(model(board)[0])
+
+    def search(solver, deadline=None, max_decisions=None):
+        solution = next(solver.solutions(propagator, limit=1, deadline=deadline,
+                                         max_decisions=max_decisions,
+                                         var_order=var_order), None)
+        return SOLVED if solution is not None else solver.stop_reason or UNSAT
+    return build, search
+
+
+def numpy_config():
+    '''Configuration solving with tenner_numpy'''
+    def build(board):
+        return tenner_array_model(board)[0]
+
+    def search(solver, deadline=None, max_decisions=None):
+        solution = next(solver.solutions(limit=1, deadline=deadline,
+                                         max_decisions=max_decisions), None)
+        return SOLVED if solution is not None else solver.stop_reason or UNSAT
+    return build, search
+
+
+#name -> (build, search). build(board) returns a solver object with
+#nDecisions and nPrunings, search(solver, deadline, max_decisions)
+#returns the status of the search (SOLVED, UNSAT, TIMEOUT or LIMIT).
+#model_2 FC is left out: it only checks the row all-different
+#constraints once a single cell is open, which makes it far slower
+#than the others. The dom/wdeg and impact configurations compare the
+#conflict driven variable orderings with MRV.
+CONFIGS = {'model_1 FC': bt_config(tenner_csp_model_1, prop_FC),
+           'model_1 FC dom/wdeg': bt_config(tenner_csp_model_1, prop_FC, 'dom/wdeg'),
+           'model_1 FC impact': bt_config(tenner_csp_model_1, prop_FC, 'impact'),
+           'model_1 GAC': bt_config(tenner_csp_model_1, prop_GAC),
+           'model_2 GAC': bt_config(tenner_csp_model_2, prop_GAC),
+           'numpy': numpy_config()}
+
+
+def completed(result):
+    '''True iff the run of result was not cut off by a limit'''
+    return result.get('status', SOLVED) in (SOLVED, UNSAT)
+
+
+def run_one(config, board, memory=True, repeat=1, timeout=None, max_decisions=None):
+    '''Build and search board with config, return its result dict. The
+       times are the smallest of repeat runs. Each search stops after
+       timeout seconds or max_decisions decisions if they are not None;
+       once a run is cut off the remaining repeats are skipped.'''
+    build, search = CONFIGS[config]
+
+    def limited_search(solver):
+        deadline = None if timeout is None else time.time() + timeout
+        return search(solver, deadline, max_decisions)
+
+    result = dict()
+    for _ in range(repeat):
+        #every build starts from an empty table cache so that its time
+        #does not depend on the boards and configurations run before it
+        table_cache.default_cache.clear()
+        wall, cpu = time.perf_counter(), time.process_time()
+        solver = build(board)
+        times = {'build_wall': time.perf_counter() - wall,
+                 'build_cpu': time.process_time() - cpu}
+        wall, cpu = time.perf_counter(), time.process_time()
+        status = limited_search(solver)
+        times['search_wall'] = time.perf_counter() - wall
+        times['search_cpu'] = time.process_time() - cpu
+        for key, t in times.items():
+            result[key] = min(result.get(key, t), t)
+        if status not in (SOLVED, UNSAT):
+            break
+    result.update({'decisions': solver.nDecisions, 'prunings': solver.nPrunings,
+                   'status': status, 'solved': status == SOLVED})
+    if memory:
+        table_cache.default_cache.clear()
+        tracemalloc.start()
+        try:
+            limited_search(build(board))
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run_suite(suite, configs, memory=True, repeat=1, verbose=False,
+              timeout=None, max_decisions=None):
+    '''Run every configuration on every board of suite (see
+       generate_suite), return the list of result dicts'''
+    results = []
+    for board_id, n, density, board in suite:
+        for config in configs:
+            result = {'board': board_id, 'n': n, 'density': density, 'config': config}
+            result.update(run_one(config, board, memory, repeat, timeout,
+                                  max_decisions))
+            if verbose:
+                print("{:16} {:19} build {:.4f}s search {:.4f}s {} decisions {}".format(
+                    board_id, config, result['build_cpu'], result['search_cpu'],
+                    result['decisions'], result['status']), file=sys.stderr)
+            results.append(result)
+    return results
+
+
+SUMMED = ['build_wall', 'build_cpu', 'search_wall', 'search_cpu',
+          'decisions', 'prunings']
+
+
+def summarize(results):
+    '''Per configuration totals of the completed results (and the
+       largest peak memory), with the number of runs of each status'''
+    summary = dict()
+    for result in results:
+        total = summary.setdefault(result['config'],
+                                   dict([(key, 0) for key in SUMMED], runs=dict()))
+        status = result.get('status', SOLVED)
+        total['runs'][status] = total['runs'].get(status, 0) + 1
+        if not completed(result):
+            continue
+        for key in SUMMED:
+            total[key] += result[key]
+        if 'peak_memory' in result:
+            total['peak_memory'] = max(total.get('peak_memory', 0),
+                                       result['peak_memory'])
+    return summary
+
+
+def compare(results, baseline, threshold, min_cpu_diff=0.05):
+    '''Compare results with baseline results (lists of result dicts)
+       over the (board, config) pairs both completed, using the same
+       seed (see the module doc for what counts as a regression).
+       Returns a list of (config, key, old, new, regressed).'''
+    runs = set((r['board'], r['config']) for r in baseline if completed(r))
+    common = [r for r in results
+              if completed(r) and (r['board'], r['config']) in runs]
+    runs = set((r['board'], r['config']) for r in common)
+    new_summary = summarize(common)
+    old_summary = summarize([r for r in baseline if (r['board'], r['config']) in runs])
+    rows = []
+    for config in sorted(new_summary):
+        new, old = new_summary[config], old_summary[config]
+        new_cpu = new['build_cpu'] + new['search_cpu']
+        old_cpu = old['build_cpu'] + old['search_cpu']
+        rows.append((config, 'cpu', old_cpu, new_cpu,
+                     new_cpu > old_cpu * (1 + threshold) and
+                     new_cpu - old_cpu > min_cpu_diff))
+        for key in ['decisions', 'prunings']:
+            rows.append((config, key, old[key], new[key], new[key] > old[key]))
+        if 'peak_memory' in new and 'peak_memory' in old:
+            rows.append((config, 'peak_memory', old['peak_memory'],
+                         new['peak_memory'],
+                         new['peak_memory'] > old['peak_memory'] * (1 + threshold)))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Tenner solvers.")
+    parser.add_argument('-o', '--output', default='-',
+                        help="JSON file for the results (default: stdout)")
+    parser.add_argument('--baseline', help="earlier results to compare with")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[3, 4, 5, 6, 7, 8])
+    parser.add_argument('--densities', type=float, nargs='+', default=[0.4, 0.6, 0.8])
+    parser.add_argument('--boards', type=int, default=2,
+                        help="boards per size and density")
+    parser.add_argument('--configs', nargs='+', choices=sorted(CONFIGS),
+                        default=sorted(CONFIGS))
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="allowed relative CPU time/memory growth")
+    parser.add_argument('--min-cpu-diff', type=float, default=0.05,
+                        help="CPU time growth (seconds, per configuration) below "
+                             "which it is taken as noise (default 0.05)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs per board and configuration, the fastest counts")
+    parser.add_argument('--timeout', type=float, default=10,
+                        help="seconds allowed per search (default 10)")
+    parser.add_argument('--max-decisions', type=int, default=100000,
+                        help="decisions allowed per search (default 100000)")
+    parser.add_argument('--no-memory', action='store_true',
+                        help="do not measure peak memory")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    suite = generate_suite(args.seed, args.sizes, args.densities, args.boards)
+    results = run_suite(suite, args.configs, not args.no_memory, args.repeat,
+                        args.verbose, args.timeout, args.max_decisions)
+    summary = summarize(results)
+    report = {'meta': {'seed': args.seed, 'sizes': args.sizes,
+                       'densities': args.densities, 'boards': args.boards,
+                       'repeat': args.repeat, 'timeout': args.timeout,
+                       'max_decisions': args.max_decisions,
+                       'configs': args.configs,
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'date': time.strftime("%Y-%m-%dT%H:%M:%S")},
+              'results': results,
+              'summary': summary}
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    regressed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('seed') != args.seed:
+            print("Warning: baseline was run with another seed", file=sys.stderr)
+        for config, key, old, new, bad in compare(results, baseline['results'],
+                                                  args.threshold, args.min_cpu_diff):
+            ratio = new / old if old else float('inf') if new else 1.0
+            print("{:19} {:12} {:>12.6g} -> {:<12.6g} x{:.3f}{}".format(
+                config, key, old, new, ratio, "  REGRESSION" if bad else ""),
+                file=sys.stderr)
+            regressed = regressed or bad
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,7 +6,7 @@ Construct and return Tenner Grid CSP models.
 '''
 
 from cspbase import *
-import itertools
+from table_cache import not_equal_tuples
 import time
 import numpy as np
 
@@ -113,13 +113,12 @@ def tenner_csp_model_1(initial_tenner_board):
     np_vars = np.array(variable_array)
     for i in range(len(variable_array[0])):
         col_list = np_vars[:,i].tolist()
-        con = Constraint("", col_list)
-        con.add_satisfying_tuples(build_nary_sum_sat_tuples(col_list, last_row[i]))
-        cons_list.append(con)
+        cons_list.append(SumConstraint("", col_list, last_row[i]))
 
-    #print(build_nary_sum_sat_tuples(variable_array[0], 10))
     for con in cons_list:
         tenner_csp.add_constraint(con)
+    #the contiguous constraints come twice, once from each cell
+    tenner_csp.normalize()
 
     return tenner_csp, variable_array
 
@@ -139,35 +138,35 @@ def contiguous_cons(var_array):
             if y > 0: #then y-1 is at least 0
                 neighbour = var_array[y-1][x]
                 con = Constraint("", [this, neighbour])
-                con.add_satisfying_tuples(build_binary_sat_tuples(this, neighbour))
+                con.use_relation(intern_relation(build_binary_sat_tuples(this, neighbour)))
                 temp_list.append(con)
 
                 if x > 0:
                     neighbour = var_array[y - 1][x-1]
                     con = Constraint("", [this, neighbour])
-                    con.add_satisfying_tuples(build_binary_sat_tuples(this, neighbour))
+                    con.use_relation(intern_relation(build_binary_sat_tuples(this, neighbour)))
                     temp_list.append(con)
                 if x < max_x:
                     neighbour = var_array[y - 1][x + 1]
                     con = Constraint("", [this, neighbour])
-                    con.add_satisfying_tuples(build_binary_sat_tuples(this, neighbour))
+                    con.use_relation(intern_relation(build_binary_sat_tuples(this, neighbour)))
                     temp_list.append(con)
 
             if y < max_y:
                 neighbour = var_array[y + 1][x]
                 con = Constraint("", [this, neighbour])
-                con.add_satisfying_tuples(build_binary_sat_tuples(this, neighbour))
+                con.use_relation(intern_relation(build_binary_sat_tuples(this, neighbour)))
                 temp_list.append(con)
 
                 if x > 0:
                     neighbour = var_array[y + 1][x-1]
                     con = Constraint("", [this, neighbour])
-                    con.add_satisfying_tuples(build_binary_sat_tuples(this, neighbour))
+                    con.use_relation(intern_relation(build_binary_sat_tuples(this, neighbour)))
                     temp_list.append(con)
                 if x < max_x:
                     neighbour = var_array[y + 1][x+1]
                     con = Constraint("", [this, neighbour])
-                    con.add_satisfying_tuples(build_binary_sat_tuples(this, neighbour))
+                    con.use_relation(intern_relation(build_binary_sat_tuples(this, neighbour)))
                     temp_list.append(con)
 
             cons_list += temp_list
@@ -179,32 +178,15 @@ def row_not_eq_cons(row_list):
     for i in range(0,10):
         for j in range(i+1,len(row_list)):
             con = Constraint("", [row_list[i], row_list[j]])
-            con.add_satisfying_tuples(build_binary_sat_tuples(row_list[i], row_list[j]))
+            con.use_relation(intern_relation(build_binary_sat_tuples(row_list[i], row_list[j])))
             cons_list.append(con)
 
     return cons_list
 
 def build_binary_sat_tuples(v1, v2):
-    sat_tuples = []
-    dom_v1 = v1.domain()
-    dom_v2 = v2.domain()
-    for t in itertools.product(dom_v1, dom_v2):
-        if t[0] != t[1]:
-            sat_tuples.append(t)
-
-    return sat_tuples
-
-def build_nary_sum_sat_tuples(var_list, _sum):
-    dom_list = []
-    sat_tuples = []
-    for var in var_list:
-        dom_list.append(var.domain())
-
-    for t in itertools.product(*dom_list):
-        if sum(t) == _sum:
-            sat_tuples.append(t)
-
-    return sat_tuples
+    #the table only depends on the two domains, so it is shared through
+    #the table cache (see table_cache.py)
+    return not_equal_tuples(v1.domain(), v2.domain())
 
 
 ##############################
@@ -273,9 +255,7 @@ def tenner_csp_model_2(initial_tenner_board):
 
     #making row constraints
     for row in variable_array:
-        con = Constraint("", row)
-        con.add_satisfying_tuples(row_all_diff_cons(row))
-        cons_list.append(con)
+        cons_list.append(AllDiffConstraint("", row))
 
     #make contiguous constraints
     for con in contiguous_cons(variable_array):
@@ -285,40 +265,15 @@ def tenner_csp_model_2(initial_tenner_board):
     np_vars = np.array(variable_array)
     for i in range(len(variable_array[0])):
         col_list = np_vars[:,i].tolist()
-        con = Constraint("", col_list)
-        con.add_satisfying_tuples(build_nary_sum_sat_tuples(col_list, last_row[i]))
-        cons_list.append(con)
+        cons_list.append(SumConstraint("", col_list, last_row[i]))
 
-    #print(build_nary_sum_sat_tuples(variable_array[0], 10))
     for con in cons_list:
         tenner_csp.add_constraint(con)
+    #the contiguous constraints come twice, once from each cell
+    tenner_csp.normalize()
 
     return tenner_csp, variable_array
 
-def row_all_diff_cons(row_list):
-    dom_list = []
-    sat_tuples = []
-    blacklist_dom = []
-    for var in row_list:
-        temp_dom = var.domain()
-        if len(temp_dom) == 1:
-            blacklist_dom += temp_dom
-
-    for var in row_list:
-        temp_dom = var.domain()
-
-        if len(temp_dom) == 1:
-            dom_list.append(temp_dom)
-        else:
-            temp_dom = [val for val in temp_dom if val not in blacklist_dom]
-            dom_list.append(temp_dom)
-
-    for t in itertools.product(*dom_list):
-        if len(set(t)) == 10:
-            sat_tuples.append(t)
-
-    return sat_tuples
-
 b1 = ([[-1, 0, 1,-1, 9,-1,-1, 5,-1, 2],
        [-1, 7,-1,-1,-1, 6, 1,-1,-1,-1],
        [-1,-1,-1, 8,-1,-1,-1,-1,-1, 9],
@@ -0,0 +1,303 @@
+'''Tenner Grid solver working on a NumPy domain tensor.
+
+   The generic propagators of propagators.py handle one Variable, one
+   constraint and one tuple at a time. The structure of a Tenner grid is
+   regular enough to propagate it all at once with array operations, so
+   here the current domains of the n rows of 10 cells are a boolean
+   array D of shape (n, 10, 10) with D[r, c, v] True iff v is still in
+   the domain of cell (r, c). One propagation round is
+
+      rows       a row holds 10 different digits, i.e. a permutation of
+                 0..9: a fixed cell removes its value from the rest of
+                 the row, and a value left in a single cell of the row
+                 fixes that cell (a wipeout if it is left in none).
+      adjacency  a fixed cell removes its value from the cells above and
+                 below it, diagonals included (left and right are in
+                 the same row).
+      columns    bounds reasoning on each column sum: a cell cannot take
+                 a value that the minimum (maximum) of the other cells
+                 of its column would push above (below) the target.
+
+   and rounds are repeated until nothing changes. Each step is a handful
+   of vectorized masks and reductions over the whole board.
+
+   The search (TennerArraySolver) is the same depth-first search as BT
+   with MRV variable ordering, with the domains copied at every choice
+   point instead of trailed (a copy is n*100 bytes). Results go back
+   through the variable_array contract of the tenner_csp models: the
+   solver is given the variable_array of a model (only the domains of
+   the Variables are used, not the constraints of the CSP) and assigns
+   the solution to those Variables, so print_tenner_soln etc. work
+   unchanged. tenner_array_model builds the Variables alone, which is
+   much cheaper than building a model's constraints.
+'''
+
+import time
+
+import numpy as np
+
+from cspbase import Variable, LIMIT, TIMEOUT
+
+VALUES = np.arange(10)
+
+
+def domain_tensor(variable_array):
+    '''Boolean (n, 10, 10) tensor of the current domains of the
+       Variables in variable_array (n rows of 10)'''
+    D = np.zeros((len(variable_array), 10, 10), dtype=bool)
+    for r, row in enumerate(variable_array):
+        for c, var in enumerate(row):
+            for val in var.cur_domain():
+                D[r, c, val] = True
+    return D
+
+
+def propagate(D, last_row):
+    '''Propagate the Tenner constraints on domain tensor D (in place)
+       until nothing changes. last_row is an array of the column sums.
+       Returns False on a domain wipeout, True otherwise.'''
+    return propagate_boards(D[None], last_row[None])[0]
+
+
+def propagate_boards(D, last_rows):
+    '''propagate for a batch of boards of the same height at once: D
+       is a (boards, n, 10, 10) domain tensor and last_rows a (boards,
+       10) array of their column sums. Every pass works on all the
+       boards that are still changing. Returns a boolean array, False
+       for the boards with a domain wipeout.'''
+    ok = np.ones(len(D), dtype=bool)
+    active = np.arange(len(D))
+    while len(active):
+        #work in place while all the boards are active, on a copy of the
+        #active ones (written back below) once some are done
+        if len(active) == len(D):
+            A = D
+            L = last_rows
+        else:
+            A = D[active]
+            L = last_rows[active]
+        good = np.ones(len(active), dtype=bool)
+        size = A.sum((1, 2, 3))
+
+        sizes = A.sum(3)
+        good &= sizes.all((1, 2))
+        fixed = A & (sizes == 1)[..., None]
+
+        #rows: fixed values are taken, every value must be placed once
+        taken = fixed.sum(2)
+        good &= (taken <= 1).all((1, 2))
+        A &= ~((taken > 0)[:, :, None, :] & ~fixed)
+        places = A.sum(2)
+        good &= places.all((1, 2))
+        single = A & (places == 1)[:, :, None, :]
+        good &= (single.sum(3) <= 1).all((1, 2))
+        forced = single.any(3)
+        A[forced] = single[forced]
+
+        #adjacency: a fixed value is not repeated above or below
+        near = np.zeros_like(A)
+        near[:, 1:] |= fixed[:, :-1]
+        near[:, 1:, 1:] |= fixed[:, :-1, :-1]
+        near[:, 1:, :-1] |= fixed[:, :-1, 1:]
+        near[:, :-1] |= fixed[:, 1:]
+        near[:, :-1, 1:] |= fixed[:, 1:, :-1]
+        near[:, :-1, :-1] |= fixed[:, 1:, 1:]
+        A &= ~near
+
+        #columns: bounds of the sums (a cell emptied above gives
+        #meaningless bounds, but its board fails on the next pass)
+        lo = A.argmax(3)
+        hi = 9 - A[..., ::-1].argmax(3)
+        sum_lo = lo.sum(1)
+        sum_hi = hi.sum(1)
+        good &= ((sum_lo <= L) & (sum_hi >= L)).all(1)
+        low = (L - sum_hi)[:, None, :] + hi
+        high = (L - sum_lo)[:, None, :] + lo
+        A &= (VALUES >= low[..., None]) & (VALUES <= high[..., None])
+
+        if A is not D:
+            D[active] = A
+        ok[active[~good]] = False
+        changed = good & (A.sum((1, 2, 3)) != size)
+        active = active[changed]
+    return ok
+
+
+#statuses of propagate_tenner_boards
+CONTRADICTION = 'contradiction'
+SOLVED = 'solved'
+OPEN = 'open'
+
+
+def board_tensor(initial_tenner_board):
+    '''(domain tensor, last_row array) of a Tenner board (see
+       tenner_csp_model_1 for the format)'''
+    board, last_row = initial_tenner_board
+    grid = np.array(board)
+    D = np.zeros(grid.shape + (10,), dtype=bool)
+    D[grid == -1] = True
+    rows, cols = np.nonzero(grid != -1)
+    D[rows, cols, grid[rows, cols]] = True
+    return D, np.array(last_row)
+
+
+def propagate_tenner_boards(initial_tenner_boards):
+    '''Root propagation of many Tenner boards at once, without building
+       a CSP per board. The boards (each in the format of
+       tenner_csp_model_1) must all have the same number of rows n.
+       Returns (statuses, D) where statuses[i] is CONTRADICTION, SOLVED
+       or OPEN for board i and D[i] its reduced domains as a (n, 10, 10)
+       boolean tensor (D[i, r, c, v] is True iff v is left for cell r, c).'''
+    tensors = [board_tensor(b) for b in initial_tenner_boards]
+    if not tensors:
+        return [], np.zeros((0, 0, 10, 10), dtype=bool)
+    if len(set(D.shape for D, last_row in tensors)) > 1:
+        raise ValueError("boards must all have the same number of rows")
+    D = np.stack([D for D, last_row in tensors])
+    last_rows = np.stack([last_row for D, last_row in tensors])
+    ok = propagate_boards(D, last_rows)
+    solved = (D.sum(3) == 1).all((1, 2))
+    statuses = []
+    for i in range(len(D)):
+        if not ok[i]:
+            statuses.append(CONTRADICTION)
+        elif solved[i]:
+            statuses.append(SOLVED)
+        else:
+            statuses.append(OPEN)
+    return statuses, D
+
+
+class TennerArraySolver:
+    '''Depth first search on a domain tensor (see the module doc). Keeps
+       nDecisions and nPrunings statistics like BT.'''
+
+    def __init__(self, variable_array, last_row):
+        '''variable_array == the n rows of 10 Variables of a Tenner
+           model, last_row == the column sums'''
+        self.variable_array = variable_array
+        self.last_row = np.array(last_row)
+        self.nDecisions = 0
+        self.nPrunings = 0
+        self.stop_reason = None
+
+    def clear_stats(self):
+        '''Initialize counters'''
+        self.nDecisions = 0
+        self.nPrunings = 0
+
+    def print_stats(self):
+        print("Search made {} variable assignments and pruned {} variable values".format(
+            self.nDecisions, self.nPrunings))
+
+    def prop(self, D):
+        '''Internal routine. propagate, counting the prunings'''
+        size = D.sum()
+        status = propagate(D, self.last_row)
+        self.nPrunings += int(size - D.sum())
+        return status
+
+    def solutions(self, limit=None, deadline=None, max_decisions=None):
+        '''Generator of the solutions, each a list of n rows of 10
+           values. Stops after limit solutions if limit is not None.
+           Also stops at the wall clock time deadline (a time.time()
+           value) or after max_decisions decisions if they are given,
+           and then stop_reason says why (TIMEOUT or LIMIT, as for
+           BT.solutions; it is None otherwise).'''
+        self.clear_stats()
+        self.stop_reason = None
+        D = domain_tensor(self.variable_array)
+        if not self.prop(D):
+            return
+        n = 0
+        #choice points: [domains before the choice, cell, values to try,
+        #index of the next one]
+        stack = []
+        while True:
+            sizes = D.sum(2)
+            if (sizes == 1).all():
+                yield D.argmax(2).tolist()
+                n += 1
+                if limit is not None and n >= limit:
+                    return
+            else:
+                #MRV: the open cell with the fewest values
+                cell = np.unravel_index(np.where(sizes > 1, sizes, 11).argmin(),
+                                        sizes.shape)
+                stack.append([D, cell, np.flatnonzero(D[cell]).tolist(), 0])
+
+            #next value at the deepest choice point with one left
+            while stack:
+                frame = stack[-1]
+                before, cell, vals, i = frame
+                if i == len(vals):
+                    stack.pop()
+                    continue
+                if max_decisions is not None and self.nDecisions >= max_decisions:
+                    self.stop_reason = LIMIT
+                    return
+                if deadline is not None and time.time() >= deadline:
+                    self.stop_reason = TIMEOUT
+                    return
+                frame[3] = i + 1
+                D = before.copy()
+                D[cell] = False
+                D[cell + (vals[i],)] = True
+                self.nDecisions += 1
+                if self.prop(D):
+                    break
+            else:
+                return
+
+    def bt_search(self):
+        '''Search for one solution, printing the outcome as BT.bt_search
+           does. On success the solution is assigned to the Variables of
+           variable_array. Returns True iff a solution was found.'''
+        stime = time.process_time()
+        for var_row in self.variable_array:
+            for var in var_row:
+                if var.is_assigned():
+                    var.unassign()
+        solution = next(self.solutions(limit=1), None)
+        if solution is None:
+            print("Tenner grid unsolved. Has no solutions")
+        else:
+            for var_row, row in zip(self.variable_array, solution):
+                for var, val in zip(var_row, row):
+                    var.assign(val)
+            print("Tenner grid solved. CPU Time used = {}".format(
+                time.process_time() - stime))
+        print("bt_search finished")
+        self.print_stats()
+        return solution is not None
+
+
+def tenner_array_model(initial_tenner_board):
+    '''Return (solver, variable_array) for a Tenner board (see
+       tenner_csp_model_1 for the format): the Variables of the board,
+       without any constraint objects, and a TennerArraySolver over
+       them'''
+    board, last_row = initial_tenner_board
+    variable_array = []
+    for i, board_row in enumerate(board):
+        row = []
+        for j, cell in enumerate(board_row):
+            var_name = "V" + str(i) + str(j)
+            if cell != -1:
+                row.append(Variable(var_name, [cell]))
+            else:
+                row.append(Variable(var_name, list(range(0, 10))))
+        variable_array.append(row)
+    return TennerArraySolver(variable_array, last_row), variable_array
+
+
+if __name__ == "__main__":
+    from tenner_csp import b1, b2
+
+    for b in [b1, b2]:
+        start_time = time.time()
+        solver, var_array = tenner_array_model(b)
+        solver.bt_search()
+        for row in var_array:
+            print([var.get_assigned_value() for var in row])
+        print("--- %s seconds for numpy solver ---" % (time.time() - start_time))